@@ -0,0 +1,54 @@
+# === 房間 actor ===
+# 同一個房間的指令排進自己的佇列，由單一 task 依序執行完（包含中間的 await）才換下一個，不同房間之間不必加鎖
+# 每個 actor 執行完一個指令就讓出事件循環，忙碌的房間只會跟其他房間輪流，不會霸佔
+# 佇列有上限，滿了就拒收（asyncio.QueueFull），由呼叫端決定怎麼回應
+# actor 只在有指令時存在：佇列清空後 task 結束並從 registry 移除，閒置房間不佔任何 task
+import asyncio
+from collections import deque
+
+
+class Actor:
+    __slots__ = ('key', 'registry', 'queue', 'task')
+
+    def __init__(self, key, registry):
+        self.key = key
+        self.registry = registry
+        self.queue = deque()
+        self.task = None
+
+    def submit(self, fn, args, force=False):
+        if not force and len(self.queue) >= self.registry.maxsize: raise asyncio.QueueFull
+        future = asyncio.get_running_loop().create_future()
+        self.queue.append((fn, args, future))
+        if self.task is None: self.task = asyncio.create_task(self.run())
+        return future
+
+    async def run(self):
+        queue = self.queue
+        while queue:
+            fn, args, future = queue.popleft()
+            try:
+                result = await fn(*args)
+            except Exception as e:
+                if not future.done(): future.set_exception(e)
+            else:
+                if not future.done(): future.set_result(result)
+            await asyncio.sleep(0)
+        # 清空與移除之間沒有 await，之後送來的指令會建立新的 actor
+        del self.registry.actors[self.key]
+
+
+class Registry:
+    def __init__(self, maxsize):
+        self.maxsize = maxsize
+        self.actors = {}
+
+    # 回傳 future；呼叫端 await 它就會等到指令在該房間的 actor 裡執行完
+    # force 給不能丟的指令（例如斷線），無視佇列上限
+    def submit(self, key, fn, *args, force=False):
+        actor = self.actors.get(key)
+        if actor is None: actor = self.actors[key] = Actor(key, self)
+        return actor.submit(fn, args, force)
+
+    def pending(self):
+        return sum(len(actor.queue) for actor in self.actors.values())
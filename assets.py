@@ -0,0 +1,167 @@
+# === 靜態資源 ===
+# 只服務 static/ 底下的檔案，啟動時一次建好所有版本放在記憶體，請求時不再讀檔或壓縮
+#   每個版本以內容雜湊當強 ETag，帶 If-None-Match 且相符就回 304
+#   index.html 以外的檔案另有帶雜湊的網址 /assets/<路徑>.<雜湊>.<副檔名>，內容變了網址就變，可以 immutable 快取一年
+#   index.html 裡引用到的檔案路徑改寫成帶雜湊的網址，index.html 本身每次以 ETag 重新驗證
+#   文字類檔案預先壓好 gzip 與 brotli（有裝 brotli 時），依 Accept-Encoding 挑最小的
+#   JPEG / PNG 另外轉一份 WebP（有裝 Pillow 時），瀏覽器 Accept 帶 image/webp 就送 WebP
+import gzip
+import hashlib
+import io
+import logging
+import mimetypes
+import os
+import time
+from functools import lru_cache
+from fastapi.responses import Response
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger('avalon')
+
+ENTRY = 'index.html'
+PREFIX = '/assets/'
+IMMUTABLE = 'public, max-age=31536000, immutable'
+REVALIDATE = 'no-cache'
+COMPRESSIBLE = ('text/', 'application/javascript', 'application/json', 'image/svg+xml')
+WEBP_SOURCES = ('image/jpeg', 'image/png')
+WEBP_QUALITY = 80
+
+
+def digest(body):
+    return hashlib.sha256(body).hexdigest()
+
+
+class Variant:
+    __slots__ = ('body', 'etag', 'media_type', 'encoding')
+
+    def __init__(self, body, media_type, encoding=None):
+        self.body = body
+        self.etag = f'"{digest(body)[:32]}"'
+        self.media_type = media_type
+        self.encoding = encoding
+
+
+class Asset:
+    __slots__ = ('path', 'url', 'media_type', 'variants', 'vary')
+
+    def __init__(self, path, body):
+        self.path = path
+        self.media_type = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+        stem, ext = os.path.splitext(path)
+        self.url = f"{PREFIX}{stem}.{digest(body)[:12]}{ext}"
+        # 依偏好排序，select 挑第一個客戶端能接受的
+        self.variants = {}
+        if self.media_type.startswith(COMPRESSIBLE):
+            if brotli is not None: self.add('br', brotli.compress(body, quality=11), len(body))
+            self.add('gzip', gzip.compress(body, 9, mtime=0), len(body))
+            self.vary = 'Accept-Encoding'
+        elif self.media_type in WEBP_SOURCES and Image is not None:
+            self.add('webp', to_webp(body), len(body))
+            self.vary = 'Accept'
+        else:
+            self.vary = None
+        self.variants['identity'] = Variant(body, self.media_type)
+
+    def add(self, key, body, original_size):
+        # 壓不小的版本不值得送
+        if body is None or len(body) >= original_size: return
+        if key == 'webp':
+            self.variants[key] = Variant(body, 'image/webp')
+        else:
+            self.variants[key] = Variant(body, self.media_type, key)
+
+    def select(self, accept_encoding, accept):
+        encodings = qvalues(accept_encoding)
+        for key, variant in self.variants.items():
+            if key == 'identity': return variant
+            if key == 'webp':
+                # 只認明確列出的 image/webp，舊瀏覽器也會送 */*
+                if qvalues(accept).get('image/webp', 0) > 0: return variant
+            elif encodings.get(key, encodings.get('*', 0)) > 0:
+                return variant
+
+
+# 'gzip;q=0.5, br, *;q=0' -> {'gzip': 0.5, 'br': 1.0, '*': 0.0}；q=0 是明確拒絕
+# 同一個瀏覽器每次送的標頭都一樣，解析結果直接快取
+@lru_cache(maxsize=256)
+def qvalues(header):
+    values = {}
+    for item in header.lower().split(','):
+        name, *params = item.split(';')
+        name = name.strip()
+        if not name: continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition('=')
+            if key.strip() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        values[name] = q
+    return values
+
+
+def to_webp(body):
+    try:
+        out = io.BytesIO()
+        Image.open(io.BytesIO(body)).save(out, 'WEBP', quality=WEBP_QUALITY, method=6)
+        return out.getvalue()
+    except OSError:
+        return None
+
+
+class Site:
+    def __init__(self, assets):
+        self.by_path = assets
+        self.by_url = {asset.url: asset for path, asset in assets.items() if path != ENTRY}
+
+
+# 讀取 directory 底下所有檔案；不跟隨 symlink 離開目錄，隱藏檔不服務
+def build(directory):
+    started = time.perf_counter()
+    directory = os.path.realpath(directory)
+    sources = {}
+    for root, dirs, files in os.walk(directory):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in files:
+            full = os.path.join(root, name)
+            if name.startswith('.') or not os.path.realpath(full).startswith(directory + os.sep): continue
+            with open(full, 'rb') as f:
+                sources[os.path.relpath(full, directory).replace(os.sep, '/')] = f.read()
+    assets = {path: Asset(path, body) for path, body in sources.items() if path != ENTRY}
+    if ENTRY in sources:
+        html = sources[ENTRY].decode('utf-8')
+        for path, asset in assets.items():
+            for quote in ('"', "'"):
+                html = html.replace(f"{quote}{path}{quote}", f"{quote}{asset.url}{quote}")
+        assets[ENTRY] = Asset(ENTRY, html.encode('utf-8'))
+    original = sum(len(body) for body in sources.values())
+    smallest = sum(min(len(v.body) for v in asset.variants.values()) for asset in assets.values())
+    logger.warning("built %d static assets (%d -> %d bytes) in %.1f ms", len(assets), original, smallest,
+                   (time.perf_counter() - started) * 1000)
+    return Site(assets)
+
+
+def etag_matches(header, etag):
+    if not header: return False
+    return any(tag.strip() in (etag, '*') for tag in header.split(','))
+
+
+def respond(request, asset, cache_control):
+    variant = asset.select(request.headers.get('accept-encoding', ''), request.headers.get('accept', ''))
+    headers = {'ETag': variant.etag, 'Cache-Control': cache_control}
+    if asset.vary: headers['Vary'] = asset.vary
+    if etag_matches(request.headers.get('if-none-match'), variant.etag):
+        return Response(status_code=304, headers=headers)
+    if variant.encoding: headers['Content-Encoding'] = variant.encoding
+    return Response(variant.body, media_type=variant.media_type, headers=headers)
@@ -0,0 +1,325 @@
+# === 壓力測試 / 延遲基準 ===
+# 在本機啟動 app_asgi，建立 N 個模擬玩家分散到 M 個房間，完整跑完
+#   join_room -> toggle_ready -> host_start_game -> select_team / vote_team / vote_mission -> assassinate
+# 統計動作延遲 p50 / p99、每秒訊息數與每位玩家收到的位元組數，結果存成 JSON 方便版本間比較
+#   pip install -r requirements-bench.txt
+#   python bench.py --players 500 --rooms 100
+#   python bench.py --players 500 --rooms 100 --compare bench_results/baseline.json
+# 延遲是客戶端觀察值：從送出動作到該玩家收到下一個狀態更新（投票以最後一票計）
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import socketio
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def percentile(samples, pct):
+    if not samples: return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct / 100))]
+
+
+class Stats:
+    def __init__(self):
+        self.latency = defaultdict(list)
+        self.frames = 0
+        self.messages = 0
+        self.bytes = 0
+        self.games = 0
+        self.errors = 0
+
+
+class BenchClient:
+    def __init__(self, url, name, stats):
+        self.url = url
+        self.name = name
+        self.stats = stats
+        self.sio = socketio.AsyncClient(reconnection=False)
+        self.token = None
+        self.role = None
+        self.state = {}
+        self.version = 0
+        self.pending = None
+        self.changed = asyncio.Condition()
+        self.sio.on('*', self.on_any)
+
+    async def on_any(self, event, data=None):
+        self.stats.frames += 1
+        self.stats.bytes += len(json.dumps(data, ensure_ascii=False).encode())
+        if event == 'batch':
+            for ev, d in data: self.handle(ev, d)
+        else:
+            self.handle(event, data)
+        async with self.changed:
+            self.changed.notify_all()
+
+    def handle(self, event, data):
+        self.stats.messages += 1
+        if event == 'join_success':
+            self.token = data['token']
+        elif event == 'role_info':
+            self.role = data['role']
+        elif event == 'update_state':
+            self.state = dict(data)
+            self.version = data['v']
+            self.settle()
+        elif event == 'state_patch':
+            if data['v'] <= self.version: return
+            if data['v'] != self.version + 1:
+                asyncio.ensure_future(self.sio.emit('request_state'))
+                return
+            self.version = data['v']
+            if 'players' in data: self.state['players'] = data['players']
+            for token, fields in data.get('player_patch', {}).items():
+                for p in self.state['players']:
+                    if p['token'] == token: p.update(fields)
+            self.state.update(data.get('set', {}))
+            self.settle()
+        elif event == 'new_message' and self.pending and self.pending[0] == 'send_chat':
+            self.settle()
+
+    def settle(self):
+        if self.pending:
+            action, started = self.pending
+            self.stats.latency[action].append(time.perf_counter() - started)
+            self.pending = None
+
+    async def act(self, event, data=None, timed=True):
+        if timed: self.pending = (event, time.perf_counter())
+        await self.sio.emit(event, data)
+
+    async def wait_for(self, predicate, timeout=30):
+        async with self.changed:
+            await asyncio.wait_for(self.changed.wait_for(lambda: bool(self.state) and predicate(self.state)), timeout)
+
+    def player(self, token):
+        return next((p for p in self.state.get('players', []) if p['token'] == token), None)
+
+
+async def play_room(url, room_id, size, stats, rng):
+    clients = [BenchClient(url, f"bot{room_id}-{i}", stats) for i in range(size)]
+    try:
+        for c in clients:
+            await c.sio.connect(url, transports=['websocket'])
+            await c.act('join_room', {'name': c.name, 'room_id': room_id, 'avatar': '🤖', 'token': None})
+            await c.wait_for(lambda st, c=c: c.player(c.token) is not None)
+        host = clients[0]
+        await host.wait_for(lambda st: len(st['players']) == size)
+        by_token = {c.token: c for c in clients}
+
+        for c in clients: await c.act('toggle_ready', room_id)
+        await host.wait_for(lambda st: all(p['is_ready'] for p in st['players']))
+        await host.act('host_start_game', room_id)
+        await host.wait_for(lambda st: st['state'] != 'LOBBY')
+
+        while True:
+            st = host.state
+            phase = st['state']
+            if phase == 'GAME_OVER': break
+            if phase == 'TEAM_SELECTION':
+                leader = by_token[next(p['token'] for p in st['players'] if p['is_leader'])]
+                tokens = [p['token'] for p in st['players']]
+                team = rng.sample(tokens, st['team_size_needed'])
+                if rng.random() < 0.3:
+                    await rng.choice(clients).act('send_chat', {'room_id': room_id, 'message': '我覺得這隊可以'})
+                await leader.act('select_team', {'room_id': room_id, 'team': team})
+                await host.wait_for(lambda st: st['state'] != 'TEAM_SELECTION')
+            elif phase == 'TEAM_VOTING':
+                quest, track = st['quest_idx'], st['vote_track']
+                *first, last = clients
+                await asyncio.gather(*(c.act('vote_team', {'room_id': room_id, 'vote': rng.random() < 0.7},
+                                             timed=False) for c in first))
+                await last.act('vote_team', {'room_id': room_id, 'vote': rng.random() < 0.7})
+                await host.wait_for(lambda st: st['state'] != 'TEAM_VOTING' or st['vote_track'] != track
+                                    or st['quest_idx'] != quest)
+            elif phase == 'MISSION':
+                quest = st['quest_idx']
+                team = [by_token[p['token']] for p in st['players'] if p['in_team']]
+                votes = [(c, not (c.role in ('刺客', '莫甘娜', '莫德雷德', '奧伯倫', '壞人') and rng.random() < 0.5))
+                         for c in team]
+                *first, last = votes
+                await asyncio.gather(*(c.act('vote_mission', {'room_id': room_id, 'result': r}, timed=False)
+                                       for c, r in first))
+                await last[0].act('vote_mission', {'room_id': room_id, 'result': last[1]})
+                await host.wait_for(lambda st: st['quest_idx'] != quest or st['state'] == 'GAME_OVER')
+            elif phase == 'ASSASSINATION':
+                assassin = next(c for c in clients if c.role == '刺客')
+                target = rng.choice([c for c in clients if c is not assassin])
+                await assassin.act('assassinate', {'room_id': room_id, 'target_token': target.token})
+                await host.wait_for(lambda st: st['state'] == 'GAME_OVER')
+            else:
+                await host.wait_for(lambda st, phase=phase: st['state'] != phase)
+        stats.games += 1
+    except (asyncio.TimeoutError, socketio.exceptions.ConnectionError, StopIteration):
+        stats.errors += 1
+    finally:
+        for c in clients:
+            if c.sio.connected: await c.sio.disconnect()
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+async def fetch_stats(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    try:
+        writer.write(f"GET /api/stats HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+        response = await reader.read()
+    finally:
+        writer.close()
+    head, _, body = response.partition(b'\r\n\r\n')
+    if not head.startswith(b'HTTP/1.1 200'): raise OSError(head.split(b'\r\n', 1)[0].decode())
+    return json.loads(body)
+
+
+# 多 worker 時監聽 socket 由主程序先開好，連得上不代表 worker 已經啟動（各自要先建好靜態資源）
+# 一次送出多個 /api/stats，直到每個 worker 都回應過才開始計時
+async def wait_until_up(url, workers, timeout=60):
+    deadline = time.monotonic() + timeout
+    host, port = url.split('//')[1].split(':')
+    seen = set()
+    while time.monotonic() < deadline:
+        results = await asyncio.gather(*(fetch_stats(host, int(port)) for _ in range(workers * 4)),
+                                       return_exceptions=True)
+        seen.update(r['worker'] for r in results if isinstance(r, dict))
+        if len(seen) >= workers: return
+        await asyncio.sleep(0.1)
+    raise SystemExit(f"server at {url} did not start ({len(seen)}/{workers} workers up)")
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def run(args):
+    proc = None
+    url = args.url
+    if not url:
+        port = free_port()
+        url = f"http://127.0.0.1:{port}"
+        # 每次都從空的伺服器開始：不載入上一輪留下的房間，結果才能跨版本比較
+        env = {**os.environ, 'AVALON_DATA_DIR': ''}
+        if args.workers > 1:
+            proc = subprocess.Popen([sys.executable, 'server.py'], cwd=HERE,
+                                    env={**env, 'PORT': str(port), 'WORKERS': str(args.workers), 'LOG_LEVEL': 'warning'})
+        else:
+            proc = subprocess.Popen([sys.executable, '-m', 'uvicorn', 'server:app_asgi', '--port', str(port),
+                                     '--log-level', 'warning'], cwd=HERE, env=env)
+    try:
+        await wait_until_up(url, args.workers)
+        stats = Stats()
+        rng = random.Random(args.seed)
+        sizes = [args.players // args.rooms + (1 if i < args.players % args.rooms else 0) for i in range(args.rooms)]
+        started = time.perf_counter()
+        sem = asyncio.Semaphore(args.concurrency)
+
+        async def limited(i, size):
+            async with sem:
+                await play_room(url, f"bench-{i}", size, stats, random.Random(rng.random()))
+
+        await asyncio.gather(*(limited(i, size) for i, size in enumerate(sizes) if size))
+        elapsed = time.perf_counter() - started
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+
+    all_samples = [s for samples in stats.latency.values() for s in samples]
+    return {
+        'version': 1,
+        'timestamp': datetime.now().isoformat(timespec='seconds'),
+        'git_rev': git_revision(),
+        'config': {'players': args.players, 'rooms': args.rooms, 'concurrency': args.concurrency,
+                   'workers': args.workers, 'seed': args.seed},
+        'results': {
+            'elapsed_s': round(elapsed, 3),
+            'games': stats.games,
+            'errors': stats.errors,
+            'frames_per_s': round(stats.frames / elapsed, 1),
+            'messages_per_s': round(stats.messages / elapsed, 1),
+            'bytes_per_client': round(stats.bytes / max(1, args.players)),
+            'latency_ms': {
+                'all': {'p50': round(percentile(all_samples, 50) * 1000, 2),
+                        'p99': round(percentile(all_samples, 99) * 1000, 2), 'n': len(all_samples)},
+                **{action: {'p50': round(percentile(samples, 50) * 1000, 2),
+                            'p99': round(percentile(samples, 99) * 1000, 2), 'n': len(samples)}
+                   for action, samples in sorted(stats.latency.items())},
+            },
+        },
+    }
+
+
+def flatten(results, prefix=''):
+    flat = {}
+    for k, v in results.items():
+        if isinstance(v, dict):
+            flat.update(flatten(v, f"{prefix}{k}."))
+        elif not k == 'n':
+            flat[prefix + k] = v
+    return flat
+
+
+# 延遲、位元組數越低越好，吞吐量越高越好；超過容忍範圍視為退步
+def compare(old, new, tolerance):
+    old_flat, new_flat = flatten(old['results']), flatten(new['results'])
+    regressions = []
+    print(f"{'metric':<32} {'baseline':>12} {'current':>12} {'change':>9}")
+    for key, value in new_flat.items():
+        base = old_flat.get(key)
+        if base is None: continue
+        change = (value - base) / base * 100 if base else 0.0
+        print(f"{key:<32} {base:>12} {value:>12} {change:>8.1f}%")
+        higher_is_better = key.endswith('_per_s') or key == 'games'
+        worse = -change if higher_is_better else change
+        if key != 'elapsed_s' and worse > tolerance: regressions.append(key)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Avalon 壓力測試')
+    parser.add_argument('--players', type=int, default=100, help='模擬玩家總數')
+    parser.add_argument('--rooms', type=int, default=20, help='房間數，每房 5~10 人最接近真實')
+    parser.add_argument('--concurrency', type=int, default=1000, help='同時進行中的房間上限')
+    parser.add_argument('--url', default=None, help='連到已啟動的伺服器而不是自己啟動一個')
+    parser.add_argument('--workers', type=int, default=1, help='自己啟動伺服器時的 worker 數；搭配 --url 時則等這麼多個 worker 都回應才開始')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', default=None, help='結果 JSON 路徑，預設 bench_results/bench-<時間>.json')
+    parser.add_argument('--compare', default=None, help='與先前的結果 JSON 比較')
+    parser.add_argument('--tolerance', type=float, default=10.0, help='比較時允許退步的百分比')
+    args = parser.parse_args()
+
+    report = asyncio.run(run(args))
+    out = args.out or os.path.join(HERE, 'bench_results', f"bench-{datetime.now():%Y%m%d-%H%M%S}.json")
+    os.makedirs(os.path.dirname(out), exist_ok=True)
+    with open(out, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(json.dumps(report['results'], ensure_ascii=False, indent=2))
+    print(f"saved {out}")
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            baseline = json.load(f)
+        regressions = compare(baseline, report, args.tolerance)
+        if regressions:
+            print(f"regressed: {', '.join(regressions)}")
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
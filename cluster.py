@@ -0,0 +1,169 @@
+# === 多程序分片 ===
+# 多個 worker 共用同一個監聽 socket，連線落在哪個 worker 都可以；每個房間依一致性雜湊只屬於一個 worker
+# 收到事件的 worker 若不是房間擁有者，就經由 bus 轉給擁有者處理，擁有者送出的訊息再經由 bus 回到連線所在的 worker
+#   WORKERS=4 python server.py
+# bus 可替換：任何實作 start / send / close 的類別都能用，以 CLUSTER_BUS=module:Class 指定
+import asyncio
+import hashlib
+import importlib
+import json
+import logging
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+from bisect import bisect
+
+logger = logging.getLogger('avalon')
+
+
+class HashRing:
+    # 每個節點放 replicas 個虛擬節點，增減 worker 時只有約 1/N 的房間換擁有者
+    def __init__(self, nodes, replicas=64):
+        self.points = sorted((self.hash(f"{node}#{i}"), node) for node in nodes for i in range(replicas))
+        self.keys = [h for h, _ in self.points]
+
+    @staticmethod
+    def hash(key):
+        # 內建 hash() 每個程序的種子不同，必須用穩定的雜湊
+        return int.from_bytes(hashlib.md5(key.encode()).digest()[:8], 'big')
+
+    def owner(self, key):
+        i = bisect(self.keys, self.hash(key)) % len(self.keys)
+        return self.points[i][1]
+
+
+# === 本機 bus ===
+# 每個 worker 在 CLUSTER_DIR 下開一個 unix socket，訊息是 4 位元組長度 + JSON
+# 同一對 worker 之間只用一條連線，送出順序就是對方處理的順序
+class LocalBus:
+    CONNECT_TIMEOUT = 10
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.server = None
+        self.connections = {}
+        self.locks = {}
+
+    def path(self, node):
+        return os.path.join(self.directory, f"node-{node}.sock")
+
+    async def start(self, node, on_message):
+        self.on_message = on_message
+        path = self.path(node)
+        if os.path.exists(path): os.remove(path)
+        self.server = await asyncio.start_unix_server(self._serve, path)
+
+    async def _serve(self, reader, writer):
+        try:
+            while True:
+                size = int.from_bytes(await reader.readexactly(4), 'big')
+                await self.on_message(json.loads(await reader.readexactly(size)))
+        except asyncio.IncompleteReadError:
+            pass
+        finally:
+            writer.close()
+
+    # 對方從不在這條連線上回傳資料，讀到 EOF 就代表對方已經關閉（例如 worker 被重啟），要重新連線
+    # 否則寫入會落在已關閉的連線上而被丟掉
+    def _alive(self, node):
+        conn = self.connections.get(node)
+        if conn is None: return None
+        reader, writer = conn
+        return writer if not writer.is_closing() and not reader.at_eof() else None
+
+    async def _writer(self, node):
+        writer = self._alive(node)
+        if writer is not None: return writer
+        lock = self.locks.setdefault(node, asyncio.Lock())
+        async with lock:
+            writer = self._alive(node)
+            if writer is not None: return writer
+            # 對方可能還在啟動或剛被重啟，短暫重試
+            deadline = time.monotonic() + self.CONNECT_TIMEOUT
+            while True:
+                try:
+                    reader, writer = await asyncio.open_unix_connection(self.path(node))
+                    break
+                except (FileNotFoundError, ConnectionRefusedError):
+                    if time.monotonic() > deadline: raise
+                    await asyncio.sleep(0.05)
+            self.connections[node] = reader, writer
+            return writer
+
+    async def send(self, node, message):
+        body = json.dumps(message, ensure_ascii=False, separators=(',', ':')).encode()
+        writer = await self._writer(node)
+        writer.write(len(body).to_bytes(4, 'big') + body)
+        if writer.transport.get_write_buffer_size() > 1 << 20: await writer.drain()
+
+    async def close(self):
+        for _, writer in self.connections.values(): writer.close()
+        if self.server:
+            self.server.close()
+            await self.server.wait_closed()
+
+
+BUSES = {'local': LocalBus}
+
+
+def load_bus(name, directory):
+    if name in BUSES: return BUSES[name](directory)
+    module_name, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module_name), attr)(directory)
+
+
+class Node:
+    def __init__(self, node_id, workers, bus):
+        self.id = node_id
+        self.ring = HashRing(range(workers))
+        self.peers = [n for n in range(workers) if n != node_id]
+        self.bus = bus
+
+    # 由 serve() 透過環境變數傳給 worker；單程序執行時回傳 None
+    @classmethod
+    def from_env(cls):
+        if 'WORKER_ID' not in os.environ: return None
+        directory = os.environ['CLUSTER_DIR']
+        return cls(int(os.environ['WORKER_ID']), int(os.environ['WORKERS']),
+                   load_bus(os.environ.get('CLUSTER_BUS', 'local'), directory))
+
+    def owner(self, room_id):
+        return self.ring.owner(room_id)
+
+
+# === 啟動器 ===
+# 主程序只負責開 socket 與看管 worker，worker 掛掉時以同一個編號重啟，房間由它自己的 journal 還原
+def serve(app, host, port, workers):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    directory = tempfile.mkdtemp(prefix='avalon-bus-')
+    env = {**os.environ, 'WORKERS': str(workers), 'CLUSTER_DIR': directory}
+
+    def spawn(i):
+        return subprocess.Popen([sys.executable, '-m', 'uvicorn', app, '--fd', str(sock.fileno()),
+                                 '--log-level', os.environ.get('LOG_LEVEL', 'info')],
+                                pass_fds=[sock.fileno()], env={**env, 'WORKER_ID': str(i)})
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    procs = [spawn(i) for i in range(workers)]
+    logger.warning("serving on %s:%d with %d workers", host, port, workers)
+    try:
+        while True:
+            time.sleep(1)
+            for i, proc in enumerate(procs):
+                if proc.poll() is not None:
+                    logger.warning("worker %d exited with %s, restarting", i, proc.returncode)
+                    procs[i] = spawn(i)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for proc in procs: proc.terminate()
+        for proc in procs: proc.wait()
+        shutil.rmtree(directory, ignore_errors=True)
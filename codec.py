@@ -0,0 +1,99 @@
+# === 精簡傳輸格式 ===
+# 客戶端連線時在 auth 帶 {codec: NAME} 就改收 msgpack 二進位附件，其他客戶端照舊收 JSON
+# 沒裝 msgpack 時 available 為 False，伺服器忽略客戶端的要求，一律送 JSON
+# 編碼規則（index.html 的 expandWire 是它的反函式，改動時兩邊一起改並更新 NAME，舊客戶端會自動退回 JSON）：
+#   狀態的 key 換成 KEYS 裡的短 key
+#   players 每位玩家、game_history 每筆紀錄、聊天訊息都改成依欄位順序排列的陣列
+#   player_patch 改成 [[token, {欄位索引: 值}], ...]，revealed_roles 改成 [[token, 角色], ...]
+#   token 是 16 bytes 的 UUID
+# batch 整批只打包一次：[[事件, 編碼後的資料], ...]
+import uuid
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+NAME = 'msgpack-v1'
+available = msgpack is not None
+
+KEYS = {
+    'state': 's', 'players': 'p', 'quest_results': 'qr', 'quest_idx': 'qi', 'team_size_needed': 'ts',
+    'vote_track': 'vt', 'settings': 'st', 'game_history': 'gh', 'host_token': 'ht', 'revealed_roles': 'rr',
+    'chat_history': 'ch', 'chat_has_more': 'cm', 'v': 'v', 'set': 'S', 'player_patch': 'pp', 'append': 'a',
+}
+PLAYER_FIELDS = ('token', 'name', 'avatar', 'is_leader', 'is_first_leader', 'in_team', 'has_voted', 'is_connected',
+                 'has_reset_voted', 'is_ready', 'role_type')
+PLAYER_INDEX = {f: i for i, f in enumerate(PLAYER_FIELDS)}
+HISTORY_FIELDS = ('quest', 'leader', 'team', 'votes', 'result', 'mission_result', 'fail_count')
+MESSAGE_FIELDS = ('id', 'time', 'msg', 'color', 'type')
+
+
+# 用在 socket.io 群組名稱：選用精簡格式的連線加入這個平行群組，而不是原本的群組
+def group(name):
+    return ' compact:' + name
+
+
+def token(t):
+    try:
+        return uuid.UUID(t).bytes
+    except (TypeError, ValueError):
+        return t
+
+
+def player_row(p):
+    return [token(p['token']) if f == 'token' else p.get(f) for f in PLAYER_FIELDS]
+
+
+def history_row(h):
+    return [h.get(f) for f in HISTORY_FIELDS]
+
+
+def message_row(m):
+    return [m.get(f) for f in MESSAGE_FIELDS]
+
+
+def encode_state(data):
+    out = {}
+    for k, v in data.items():
+        if k == 'players':
+            v = [player_row(p) for p in v]
+        elif k == 'player_patch':
+            v = [[token(t), {PLAYER_INDEX[f]: x for f, x in fields.items()}] for t, fields in v.items()]
+        elif k == 'game_history':
+            v = [history_row(h) for h in v]
+        elif k == 'chat_history':
+            v = [message_row(m) for m in v]
+        elif k == 'host_token':
+            v = token(v) if v else v
+        elif k == 'revealed_roles':
+            v = [[token(t), role] for t, role in v.items()]
+        elif k in ('set', 'append'):
+            v = encode_state(v)
+        out[KEYS.get(k, k)] = v
+    return out
+
+
+def encode_history_page(data):
+    return {'messages': [message_row(m) for m in data['messages']], 'has_more': data['has_more']}
+
+
+def encode_join(data):
+    return {**data, 'token': token(data['token'])}
+
+
+ENCODERS = {
+    'update_state': encode_state, 'state_patch': encode_state, 'new_message': message_row,
+    'history_page': encode_history_page, 'join_success': encode_join,
+}
+
+
+def transform(event, data):
+    encoder = ENCODERS.get(event)
+    return encoder(data) if encoder else data
+
+
+def encode(event, data):
+    if event == 'batch':
+        return msgpack.packb([[ev, transform(ev, d)] for ev, d in data], use_bin_type=True)
+    return msgpack.packb(transform(event, data), use_bin_type=True)
@@ -0,0 +1,109 @@
+# === 遊戲規則引擎 ===
+# 純函式、不做 I/O，隨機性一律由呼叫端傳入的 rng (random.Random) 決定，可重現
+# server.py 的事件處理與 simulate.py 的離線模擬共用同一份規則
+
+# === 遊戲平衡設定 ===
+BALANCE_CONFIG = {
+    1: (1, 0), 2: (1, 1), 3: (2, 1), 4: (3, 1),
+    5: (3, 2), 6: (4, 2), 7: (4, 3),
+    8: (5, 3), 9: (6, 3), 10: (6, 4)
+}
+QUEST_CONFIG = {
+    1: [1, 1, 1, 1, 1], 2: [1, 1, 1, 1, 1], 3: [1, 2, 1, 2, 2], 4: [2, 2, 2, 3, 3],
+    5: [2, 3, 2, 3, 3], 6: [2, 3, 4, 3, 4], 7: [2, 3, 3, 4, 4],
+    8: [3, 4, 4, 5, 5], 9: [3, 4, 4, 5, 5], 10: [3, 4, 4, 5, 5],
+}
+
+MERLIN = "梅林"
+PERCIVAL = "派西維爾"
+LOYAL = "忠臣"
+ASSASSIN = "刺客"
+MORGANA = "莫甘娜"
+MORDRED = "莫德雷德"
+OBERON = "奧伯倫"
+MINION = "壞人"
+
+# 設定開關 -> 角色，順序即發牌前的牌組順序
+SPECIAL_ROLES = [('merlin', MERLIN), ('percival', PERCIVAL), ('assassin', ASSASSIN), ('morgana', MORGANA),
+                 ('mordred', MORDRED), ('oberon', OBERON)]
+GOOD_ROLES = frozenset([MERLIN, PERCIVAL, LOYAL])
+EVIL_ROLES = frozenset([ASSASSIN, MORGANA, MORDRED, OBERON, MINION])
+
+MAX_VOTE_TRACK = 5
+WINS_NEEDED = 3
+
+
+def build_deck(settings, count):
+    target_good, target_evil = BALANCE_CONFIG.get(count, (1, 0))
+    deck = [role for key, role in SPECIAL_ROLES if settings.get(key)]
+    current_good = len([r for r in deck if r in GOOD_ROLES])
+    current_evil = len([r for r in deck if r in EVIL_ROLES])
+    deck += [LOYAL] * max(0, target_good - current_good)
+    deck += [MINION] * max(0, target_evil - current_evil)
+    if len(deck) > count: deck = deck[:count]
+    while len(deck) < count: deck.append(LOYAL)
+    return deck
+
+
+def deal_roles(settings, count, rng):
+    deck = build_deck(settings, count)
+    rng.shuffle(deck)
+    return deck
+
+
+def team_size(count, quest_index):
+    try:
+        return QUEST_CONFIG[count][quest_index]
+    except (KeyError, IndexError):
+        return 0
+
+
+def tally_votes(votes):
+    approves = sum(1 for v in votes if v)
+    rejects = len(votes) - approves
+    return approves, rejects, approves > rejects
+
+
+def fails_required(count, quest_index):
+    return 2 if count >= 7 and quest_index == 3 else 1
+
+
+def mission_succeeded(results, count, quest_index):
+    fail_count = sum(1 for r in results if not r)
+    return fail_count < fails_required(count, quest_index), fail_count
+
+
+def next_leader(leader_index, count):
+    return (leader_index + 1) % count
+
+
+# 回傳 'ASSASSINATION'（藍方三勝，進入刺殺）、'RED'（紅方三敗）或 None（繼續）
+def quest_outcome(quest_results):
+    if quest_results.count(True) >= WINS_NEEDED: return 'ASSASSINATION'
+    if quest_results.count(False) >= WINS_NEEDED: return 'RED'
+    return None
+
+
+def assassination_succeeded(target_role):
+    return target_role == MERLIN
+
+
+# 發牌後一次算出每個座位能看到哪些座位，整局固定不變
+# 派西維爾看到的梅林 / 莫甘娜順序只在這裡由 rng 打亂一次
+def visibility_table(roles, rng):
+    evil = [i for i, r in enumerate(roles) if r in EVIL_ROLES]
+    evil_view = [i for i in evil if roles[i] != OBERON]
+    merlin_view = [i for i in evil if roles[i] != MORDRED]
+    percival_view = [i for i, r in enumerate(roles) if r in (MERLIN, MORGANA)]
+    rng.shuffle(percival_view)
+    table = []
+    for seat, role in enumerate(roles):
+        if role in (MORGANA, ASSASSIN, MINION, MORDRED):
+            table.append([i for i in evil_view if i != seat])
+        elif role == MERLIN:
+            table.append(merlin_view)
+        elif role == PERCIVAL:
+            table.append(percival_view)
+        else:
+            table.append([])
+    return table
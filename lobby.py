@@ -0,0 +1,65 @@
+# === 大廳目錄 ===
+# 每個房間一筆摘要 (狀態, 上場人數, 觀戰人數)，另外依 (狀態, 上場人數) 分桶，桶內是排序好的房號
+# update 只在摘要真的改變時搬桶，房間每次廣播都可以呼叫；查詢只碰符合條件的桶，不必掃過所有房間
+# 分頁用游標：after 是上一頁最後一個房號，翻頁途中有房間新增或移除也不會重複或跳過
+import heapq
+from bisect import bisect_left, bisect_right, insort
+from itertools import islice
+from models import GameState
+
+
+class Directory:
+    def __init__(self, max_seats):
+        self.max_seats = max_seats
+        self.entries = {}
+        self.buckets = {}
+
+    # 只有 LOBBY 的房間還能入座，開局後加入的人都是旁觀
+    def open_seats(self, state, players):
+        return max(0, self.max_seats - players) if state == GameState.LOBBY else 0
+
+    # 回傳摘要是否有變
+    def update(self, room_id, state, players, spectators):
+        entry = (state, players, spectators)
+        old = self.entries.get(room_id)
+        if old == entry: return False
+        self.entries[room_id] = entry
+        if old is None or old[:2] != entry[:2]:
+            if old is not None: self._unbucket(room_id, old)
+            insort(self.buckets.setdefault(entry[:2], []), room_id)
+        return True
+
+    def remove(self, room_id):
+        old = self.entries.pop(room_id, None)
+        if old is None: return False
+        self._unbucket(room_id, old)
+        return True
+
+    def _unbucket(self, room_id, entry):
+        bucket = self.buckets[entry[:2]]
+        del bucket[bisect_left(bucket, room_id)]
+        if not bucket: del self.buckets[entry[:2]]
+
+    def summary(self, room_id):
+        state, players, spectators = self.entries[room_id]
+        return {'room_id': room_id, 'state': state, 'players': players, 'spectators': spectators,
+                'open_seats': self.open_seats(state, players)}
+
+    def query(self, states=None, min_players=0, max_players=None, min_open_seats=0, after=None, limit=20):
+        buckets = [bucket for (state, players), bucket in self.buckets.items()
+                   if (not states or state in states) and players >= min_players
+                   and (max_players is None or players <= max_players)
+                   and self.open_seats(state, players) >= min_open_seats]
+        total = sum(map(len, buckets))
+        merged = heapq.merge(*(tail(bucket, after) for bucket in buckets))
+        page = list(islice(merged, limit + 1))
+        has_more = len(page) > limit
+        page = page[:limit]
+        return {'rooms': [self.summary(room_id) for room_id in page], 'total': total,
+                'next': page[-1] if has_more else None}
+
+
+# 從 after 之後開始逐一取出，不複製整個桶
+def tail(bucket, after):
+    start = 0 if after is None else bisect_right(bucket, after)
+    return (bucket[i] for i in range(start, len(bucket)))
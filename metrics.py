@@ -0,0 +1,150 @@
+# === 監控指標 ===
+# 事件處理時間、送出次數 / 大小、房間與連線數，以 Prometheus 文字格式輸出
+# 熱路徑上只有 perf_counter、bisect 與整數加法，可以常駐開啟
+import json
+import logging
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from functools import wraps
+
+logger = logging.getLogger('avalon')
+
+# 超過這個毫秒數的事件處理會寫一筆 warning，0 表示關閉
+SLOW_HANDLER_MS = float(os.environ.get("SLOW_HANDLER_MS", 0))
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+SIZE_BUCKETS = (64, 256, 1024, 4096, 16384, 65536, 262144)
+
+# payload 大小要另外序列化一次才量得到，每種事件只抽樣 1/PAYLOAD_SAMPLE 次，位元組總數依抽樣比例放大
+PAYLOAD_SAMPLE = max(1, int(os.environ.get("PAYLOAD_SAMPLE", 16)))
+
+
+class Histogram:
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class LabeledHistogram:
+    def __init__(self, name, help, label, buckets):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.buckets = buckets
+        self.children = {}
+
+    def get(self, value):
+        child = self.children.get(value)
+        if child is None: child = self.children[value] = Histogram(self.buckets)
+        return child
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        for value, h in sorted(self.children.items()):
+            label = f'{self.label}="{value}"'
+            total = 0
+            for bound, n in zip(self.buckets, h.counts):
+                total += n
+                lines.append(f'{self.name}_bucket{{{label},le="{bound}"}} {total}')
+            lines.append(f'{self.name}_bucket{{{label},le="+Inf"}} {h.count}')
+            lines.append(f'{self.name}_sum{{{label}}} {h.sum}')
+            lines.append(f'{self.name}_count{{{label}}} {h.count}')
+        return lines
+
+
+class LabeledCounter:
+    def __init__(self, name, help, label):
+        self.name = name
+        self.help = help
+        self.label = label
+        self.values = defaultdict(int)
+
+    def inc(self, value, amount=1):
+        self.values[value] += amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        for value, n in sorted(self.values.items()):
+            lines.append(f'{self.name}{{{self.label}="{value}"}} {n}')
+        return lines
+
+
+handler_seconds = LabeledHistogram('avalon_handler_seconds', 'Socket.IO 事件處理時間', 'event', LATENCY_BUCKETS)
+handler_errors = LabeledCounter('avalon_handler_errors_total', '事件處理拋出例外的次數', 'event')
+emit_seconds = LabeledHistogram('avalon_emit_seconds', 'sio.emit 耗時', 'event', LATENCY_BUCKETS)
+emit_payload_bytes = LabeledHistogram('avalon_emit_payload_bytes', '單次送出的 payload 大小', 'event', SIZE_BUCKETS)
+emit_bytes = LabeledCounter('avalon_emit_bytes_total', '送出的 payload 位元組數（乘上收件人數，抽樣估計）', 'event')
+emit_recipients = LabeledCounter('avalon_emit_recipients_total', '送出的訊息份數（乘上收件人數）', 'event')
+commands_dropped = LabeledCounter('avalon_room_commands_dropped_total', '房間佇列已滿而拒收的事件數', 'event')
+events_throttled = LabeledCounter('avalon_events_throttled_total', '超出流量預算而被擋下的事件數', 'event')
+chat_flood = LabeledCounter('avalon_chat_flood_total', '超出預算的聊天訊息，merged 為延後合併送出，dropped 為丟掉', 'outcome')
+
+# 由 server.py 註冊：name -> (help, 回傳數值的函式)，只在抓取 /metrics 時計算
+gauges = {}
+
+
+def gauge(name, help, fn):
+    gauges[name] = (help, fn)
+
+
+def timed(name, handler):
+    hist = handler_seconds.get(name)
+
+    @wraps(handler)
+    async def wrapper(*args):
+        started = time.perf_counter()
+        try:
+            return await handler(*args)
+        except Exception:
+            handler_errors.inc(name)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            hist.observe(elapsed)
+            if SLOW_HANDLER_MS and elapsed * 1000 >= SLOW_HANDLER_MS:
+                logger.warning("slow handler %s: %.1f ms", name, elapsed * 1000)
+    return wrapper
+
+
+def record_emit(event, elapsed):
+    emit_seconds.get(event).observe(elapsed)
+
+
+payload_seen = defaultdict(int)
+
+
+def record_payload(event, data, recipients):
+    emit_recipients.inc(event, recipients)
+    seen = payload_seen[event]
+    payload_seen[event] = seen + 1
+    if seen % PAYLOAD_SAMPLE: return
+    size = len(json.dumps(data, separators=(',', ':')))
+    emit_payload_bytes.get(event).observe(size)
+    emit_bytes.inc(event, size * recipients * PAYLOAD_SAMPLE)
+
+
+def render():
+    lines = []
+    for name, (help, fn) in gauges.items():
+        lines += [f"# HELP {name} {help}", f"# TYPE {name} gauge"]
+        value = fn()
+        if isinstance(value, dict):
+            for label, n in sorted(value.items()):
+                lines.append(f'{name}{{{label[0]}="{label[1]}"}} {n}')
+        else:
+            lines.append(f"{name} {value}")
+    for metric in (handler_seconds, handler_errors, emit_seconds, emit_payload_bytes, emit_bytes, emit_recipients,
+                   commands_dropped, events_throttled, chat_flood):
+        lines += metric.render()
+    return '\n'.join(lines) + '\n'
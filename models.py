@@ -0,0 +1,174 @@
+from bisect import insort
+from collections import deque
+from itertools import islice
+
+
+class GameState:
+    LOBBY = 'LOBBY'
+    TEAM_SELECTION = 'TEAM_SELECTION'
+    TEAM_VOTING = 'TEAM_VOTING'
+    MISSION = 'MISSION'
+    ASSASSINATION = 'ASSASSINATION'
+    GAME_OVER = 'GAME_OVER'
+
+
+DEFAULT_SETTINGS = {'merlin': True, 'percival': True, 'assassin': True, 'morgana': True, 'mordred': False,
+                    'oberon': False}
+
+
+class Player:
+    __slots__ = ('token', 'name', 'avatar', 'sid', 'role', 'join_time', 'connected', 'is_ready')
+
+    def __init__(self, token, name, avatar, sid, role, join_time, connected=True, is_ready=False):
+        self.token = token
+        self.name = name
+        self.avatar = avatar
+        self.sid = sid
+        self.role = role
+        self.join_time = join_time
+        self.connected = connected
+        self.is_ready = is_ready
+
+    @property
+    def is_spectator(self):
+        return self.role == 'spectator'
+
+    def to_dict(self):
+        return {'token': self.token, 'name': self.name, 'avatar': self.avatar, 'role': self.role,
+                'join_time': self.join_time, 'is_ready': self.is_ready}
+
+    # 還原時一律視為離線，等玩家重連再補上 sid
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d['token'], d['name'], d['avatar'], None, d['role'], d['join_time'], connected=False,
+                   is_ready=d['is_ready'])
+
+
+class Room:
+    # seats 是依加入時間排序的上場玩家 token，加入 / 踢人 / 換身分時增量維護，不必每次重新排序
+    # online_players / online_spectators 是在線的上場玩家與觀戰者人數，同樣增量維護；
+    # 玩家的 connected 與身分一律經過 add_player / remove_player / set_role / set_connected 修改
+    __slots__ = ('room_id', 'players', 'seats', 'state', 'quest_results', 'quest_index', 'leader_index',
+                 'current_team', 'team_set', 'votes', 'mission_votes', 'mission_votes_who', 'vote_track',
+                 'chat_history', 'chat_seq', 'reset_votes', 'game_history', 'current_history_entry',
+                 'first_leader_token', 'settings', 'visibility', 'version', 'synced_state',
+                 'spectator_version', 'spectator_synced', 'online_players', 'online_spectators')
+
+    def __init__(self, room_id, chat_limit=None):
+        self.room_id = room_id
+        self.players = {}
+        self.seats = []
+        self.state = GameState.LOBBY
+        self.quest_results = [None] * 5
+        self.quest_index = 0
+        self.leader_index = 0
+        self.current_team = []
+        self.team_set = frozenset()
+        self.votes = {}
+        self.mission_votes = []
+        self.mission_votes_who = set()
+        self.vote_track = 0
+        self.chat_history = deque(maxlen=chat_limit)
+        self.chat_seq = 0
+        self.reset_votes = set()
+        self.game_history = []
+        self.current_history_entry = None
+        self.first_leader_token = None
+        self.settings = dict(DEFAULT_SETTINGS)
+        self.visibility = {}
+        self.version = 0
+        self.synced_state = None
+        self.spectator_version = 0
+        self.spectator_synced = None
+        self.online_players = 0
+        self.online_spectators = 0
+
+    @property
+    def active_count(self):
+        return len(self.seats)
+
+    @property
+    def leader_token(self):
+        return self.seats[self.leader_index] if self.seats else None
+
+    def seat_key(self, token):
+        return self.players[token].join_time
+
+    def count_online(self, player, delta):
+        if not player.connected: return
+        if player.is_spectator:
+            self.online_spectators += delta
+        else:
+            self.online_players += delta
+
+    def add_player(self, player):
+        self.players[player.token] = player
+        if not player.is_spectator: insort(self.seats, player.token, key=self.seat_key)
+        self.count_online(player, 1)
+
+    def remove_player(self, token):
+        player = self.players.pop(token)
+        if not player.is_spectator: self.seats.remove(token)
+        self.count_online(player, -1)
+        return player
+
+    def set_connected(self, token, connected):
+        player = self.players[token]
+        if player.connected == connected: return
+        self.count_online(player, -1)
+        player.connected = connected
+        self.count_online(player, 1)
+
+    def set_role(self, token, role):
+        player = self.players[token]
+        was_spectator = player.is_spectator
+        self.count_online(player, -1)
+        player.role = role
+        self.count_online(player, 1)
+        if was_spectator and not player.is_spectator:
+            insort(self.seats, token, key=self.seat_key)
+        elif not was_spectator and player.is_spectator:
+            self.seats.remove(token)
+
+    def set_team(self, tokens):
+        self.current_team = list(tokens)
+        self.team_set = frozenset(self.current_team)
+
+    # 持久化用；version / synced_state / spectator_synced 是對當下連線做差異同步用的，不需要保存
+    # chat_tail 指定時只保存最新的幾則聊天
+    def to_dict(self, chat_tail=None):
+        chat = self.chat_history
+        if chat_tail is not None: chat = islice(chat, max(0, len(chat) - chat_tail), None)
+        return {
+            'room_id': self.room_id, 'players': [p.to_dict() for p in self.players.values()],
+            'state': self.state, 'quest_results': self.quest_results, 'quest_index': self.quest_index,
+            'leader_index': self.leader_index, 'current_team': self.current_team, 'votes': self.votes,
+            'mission_votes': self.mission_votes, 'mission_votes_who': list(self.mission_votes_who),
+            'vote_track': self.vote_track, 'chat_history': list(chat), 'chat_seq': self.chat_seq,
+            'reset_votes': list(self.reset_votes), 'game_history': self.game_history,
+            'current_history_entry': self.current_history_entry, 'first_leader_token': self.first_leader_token,
+            'settings': self.settings, 'visibility': self.visibility,
+        }
+
+    @classmethod
+    def from_dict(cls, d, chat_limit=None):
+        room = cls(d['room_id'], chat_limit=chat_limit)
+        for p in d['players']: room.add_player(Player.from_dict(p))
+        room.state = d['state']
+        room.quest_results = d['quest_results']
+        room.quest_index = d['quest_index']
+        room.leader_index = d['leader_index']
+        room.set_team(d['current_team'])
+        room.votes = d['votes']
+        room.mission_votes = d['mission_votes']
+        room.mission_votes_who = set(d['mission_votes_who'])
+        room.vote_track = d['vote_track']
+        room.chat_history.extend(d['chat_history'])
+        room.chat_seq = d['chat_seq']
+        room.reset_votes = set(d['reset_votes'])
+        room.game_history = d['game_history']
+        room.current_history_entry = d['current_history_entry']
+        room.first_leader_token = d['first_leader_token']
+        room.settings = d['settings']
+        room.visibility = d['visibility']
+        return room
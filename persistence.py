@@ -0,0 +1,144 @@
+# === 房間持久化 ===
+# 每個改變狀態的動作寫成一行 JSON 附加到 write-ahead log，定期寫整份快照
+# 寫檔與 fsync 都丟到單一背景執行緒，事件循環只負責把紀錄放進緩衝區
+# 快照的房間由呼叫端序列化成 JSON 字串（可以只重做有變動的房間），組成整份檔案也在背景執行緒
+# 重啟時載入最新快照，再依序重播快照之後的紀錄
+#   data/snapshot.json          {"seq": 最後納入快照的序號, "rooms": [...]}
+#   data/wal-<起始序號>.log      每行 {"s": 序號, "t": 時間, "r": 房間, "op": 動作, "a": [參數]}
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger('avalon')
+
+SNAPSHOT_FILE = 'snapshot.json'
+
+
+def segment_name(first_seq):
+    return f"wal-{first_seq:012d}.log"
+
+
+def segment_start(name):
+    return int(name[4:-4])
+
+
+# 快照是 _write_snapshot 組出來的 {"seq":N,"rooms":[...]}，逐一解析房間並保留各自的原始字串
+def parse_snapshot(text):
+    head, _, body = text.partition(',"rooms":[')
+    seq = int(head[len('{"seq":'):])
+    decoder = json.JSONDecoder()
+    rooms, pos = [], 0
+    while body[pos] != ']':
+        room, end = decoder.raw_decode(body, pos)
+        rooms.append((room, body[pos:end]))
+        pos = end + 1 if body[end] == ',' else end
+    return seq, rooms
+
+
+class Journal:
+    def __init__(self, directory, flush_interval=0.05, snapshot_interval=60):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.snapshot_interval = snapshot_interval
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='journal')
+        self.buffer = []
+        self.seq = 0
+        self.segment = None
+        self.last_snapshot = time.monotonic()
+
+    def segments(self):
+        return sorted((n for n in os.listdir(self.directory) if n.startswith('wal-') and n.endswith('.log')),
+                      key=segment_start)
+
+    # 回傳 (快照裡的房間 [(資料, 原始 JSON 字串)], 快照之後要重播的紀錄)；呼叫後 journal 從下一個序號接著寫
+    # 原始字串讓呼叫端不必為沒變動的房間重新序列化
+    def recover(self):
+        os.makedirs(self.directory, exist_ok=True)
+        snapshot_seq, rooms = 0, []
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                snapshot_seq, rooms = parse_snapshot(f.read())
+        records = []
+        self.seq = snapshot_seq
+        for name in self.segments():
+            path = os.path.join(self.directory, name)
+            good = torn = 0
+            with open(path, 'rb') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        torn = len(line)
+                        break
+                    good += len(line)
+                    if record['s'] > snapshot_seq: records.append(record)
+                    self.seq = max(self.seq, record['s'])
+            if torn:
+                # 當機時寫到一半的最後一行：截掉，之後若接著寫同一個檔案，新紀錄才不會黏在它後面一起被丟掉
+                logger.warning("journal %s: dropping torn record (%d bytes)", name, torn)
+                os.truncate(path, good)
+        self.segment = segment_name(self.seq + 1)
+        return rooms, records
+
+    def append(self, room_id, op, args, t):
+        self.seq += 1
+        record = {'s': self.seq, 't': t, 'r': room_id, 'op': op, 'a': args}
+        self.buffer.append(json.dumps(record, ensure_ascii=False, separators=(',', ':')) + '\n')
+
+    def _write(self, segment, lines):
+        with open(os.path.join(self.directory, segment), 'a', encoding='utf-8') as f:
+            f.write(''.join(lines))
+            f.flush()
+            os.fsync(f.fileno())
+
+    async def flush(self):
+        if not self.buffer: return
+        lines, self.buffer = self.buffer, []
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._write, self.segment, lines)
+
+    def _write_snapshot(self, seq, rooms, obsolete):
+        payload = '{"seq":%d,"rooms":[%s]}' % (seq, ','.join(rooms))
+        path = os.path.join(self.directory, SNAPSHOT_FILE)
+        tmp = path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+        if hasattr(os, 'O_DIRECTORY'):
+            fd = os.open(self.directory, os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        for name in obsolete:
+            os.remove(os.path.join(self.directory, name))
+
+    # dump_rooms 回傳每個房間的 JSON 字串；它在事件循環裡同步呼叫，快照內容才會剛好對應到當下的序號
+    # 字串不可變，之後的修改不會影響已交給背景執行緒的內容
+    async def snapshot(self, dump_rooms):
+        await self.flush()
+        seq = self.seq
+        rooms = dump_rooms()
+        obsolete = [n for n in self.segments() if segment_start(n) <= seq]
+        self.segment = segment_name(seq + 1)
+        await asyncio.get_running_loop().run_in_executor(self.executor, self._write_snapshot, seq, rooms, obsolete)
+        self.last_snapshot = time.monotonic()
+
+    async def run(self, dump_rooms):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                if time.monotonic() - self.last_snapshot >= self.snapshot_interval:
+                    await self.snapshot(dump_rooms)
+            except OSError:
+                logger.exception("journal write failed")
+
+    async def close(self, dump_rooms):
+        await self.snapshot(dump_rooms)
+        self.executor.shutdown()
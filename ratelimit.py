@@ -0,0 +1,71 @@
+# === 流量限制 ===
+# 每個 key（連線 sid 或房號）每種事件一個 token bucket：每秒補 rate 個，最多累積 burst 個，每次事件用掉一個
+# 預算表是 {事件: (rate, burst)}，沒列出的事件用 '*'；只在 key 第一次送出該事件時建立 bucket，forget 時整批移除
+# 全部是同步的浮點運算，不需要計時器
+import time
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+    def refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self, now):
+        self.refill(now)
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+    # 距離下一個 token 還要幾秒
+    def wait(self, now):
+        self.refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+
+class Limiter:
+    def __init__(self, budgets):
+        self.budgets = budgets
+        self.buckets = {}
+
+    def bucket(self, key, event, now):
+        buckets = self.buckets.get(key)
+        if buckets is None: buckets = self.buckets[key] = {}
+        bucket = buckets.get(event)
+        if bucket is None:
+            rate, burst = self.budgets.get(event) or self.budgets['*']
+            bucket = buckets[event] = TokenBucket(rate, burst, now)
+        return bucket
+
+    def take(self, key, event):
+        now = time.monotonic()
+        return self.bucket(key, event, now).take(now)
+
+    def wait(self, key, event):
+        now = time.monotonic()
+        return self.bucket(key, event, now).wait(now)
+
+    # 後面的檢查沒過時把用掉的 token 還回去
+    def refund(self, key, event):
+        bucket = self.buckets[key][event]
+        bucket.tokens = min(bucket.burst, bucket.tokens + 1)
+
+    def forget(self, key):
+        self.buckets.pop(key, None)
+
+
+# 預算字串："send_chat=2/6,*=10/20" 表示 send_chat 每秒 2 次、最多連發 6 次，其他事件每秒 10 次、最多 20 次
+def parse_budgets(text, defaults):
+    budgets = dict(defaults)
+    for item in filter(None, (part.strip() for part in text.split(','))):
+        event, _, spec = item.partition('=')
+        rate, _, burst = spec.partition('/')
+        budgets[event.strip()] = (float(rate), float(burst or rate))
+    return budgets
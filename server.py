@@ -1,458 +1,1308 @@
 import socketio
+import asyncio
+import json
+import logging
 import random
+import time
 import uuid
 import os
 import uvicorn
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from itertools import islice
 from datetime import datetime
-from fastapi import FastAPI
-from fastapi.staticfiles import StaticFiles
+from fastapi import FastAPI, HTTPException, Query, Request
+from fastapi.responses import PlainTextResponse
 from fastapi.middleware.cors import CORSMiddleware
+from models import GameState, Room, Player
+import engine
+import metrics
+import persistence
+import cluster
+import actors
+import codec
+import assets
+import lobby
+import ratelimit
 
 # === 基礎設定 ===
-sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*')
-app = FastAPI()
+# 以 WORKERS>1 啟動時每個 worker 的 node 描述自己的編號與 bus；多 worker 只開 websocket，polling 的請求會落在不同 worker
+node = cluster.Node.from_env()
+sio = socketio.AsyncServer(async_mode='asgi', cors_allowed_origins='*', transports=['websocket'] if node else None)
+
+
+@asynccontextmanager
+async def lifespan(app):
+    global site
+    site = await asyncio.get_running_loop().run_in_executor(None, assets.build, STATIC_DIR)
+    if journal: restore_rooms()
+    if node: await node.bus.start(node.id, on_bus_message)
+    tasks = [asyncio.create_task(room_sweeper()), asyncio.create_task(spectator_ticker())]
+    if node: tasks.append(asyncio.create_task(sync_lobby()))
+    if journal: tasks.append(asyncio.create_task(journal.run(dump_rooms)))
+    yield
+    for task in tasks: task.cancel()
+    if journal: await journal.close(dump_rooms)
+    if node: await node.bus.close()
+
+
+app = FastAPI(lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"],
                    allow_headers=["*"])
 app_asgi = socketio.ASGIApp(sio, app)
-app.mount("/", StaticFiles(directory=".", html=True), name="static")
-
-# === 遊戲平衡設定 ===
-BALANCE_CONFIG = {
-    1: (1, 0), 2: (1, 1), 3: (2, 1), 4: (3, 1),
-    5: (3, 2), 6: (4, 2), 7: (4, 3),
-    8: (5, 3), 9: (6, 3), 10: (6, 4)
-}
-QUEST_CONFIG = {
-    1: [1, 1, 1, 1, 1], 2: [1, 1, 1, 1, 1], 3: [1, 2, 1, 2, 2], 4: [2, 2, 2, 3, 3],
-    5: [2, 3, 2, 3, 3], 6: [2, 3, 4, 3, 4], 7: [2, 3, 3, 4, 4],
-    8: [3, 4, 4, 5, 5], 9: [3, 4, 4, 5, 5], 10: [3, 4, 4, 5, 5],
-}
 
-rooms = {}
+rng = random.Random()
+logger = logging.getLogger('avalon')
 
+# 聊天紀錄環狀緩衝：每房最多保留 CHAT_HISTORY_LIMIT 則，快照只帶最新 CHAT_SNAPSHOT_SIZE 則，更早的用 fetch_history 翻頁
+CHAT_HISTORY_LIMIT = int(os.environ.get("CHAT_HISTORY_LIMIT", 500))
+CHAT_SNAPSHOT_SIZE = int(os.environ.get("CHAT_SNAPSHOT_SIZE", 50))
+CHAT_PAGE_LIMIT = 100
 
-class GameState:
-    LOBBY = 'LOBBY'
-    TEAM_SELECTION = 'TEAM_SELECTION'
-    TEAM_VOTING = 'TEAM_VOTING'
-    MISSION = 'MISSION'
-    ASSASSINATION = 'ASSASSINATION'
-    GAME_OVER = 'GAME_OVER'
+# 閒置房間回收：全員離線超過 ROOM_IDLE_TTL 秒，或停在 LOBBY/GAME_OVER 超過 ROOM_LOBBY_TTL 秒就刪除
+ROOM_IDLE_TTL = int(os.environ.get("ROOM_IDLE_TTL", 600))
+ROOM_LOBBY_TTL = int(os.environ.get("ROOM_LOBBY_TTL", 3600))
+ROOM_SWEEP_INTERVAL = int(os.environ.get("ROOM_SWEEP_INTERVAL", 30))
 
+# 每個房間的指令佇列上限，超過就拒收並回覆 busy
+ROOM_QUEUE_SIZE = int(os.environ.get("ROOM_QUEUE_SIZE", 64))
 
-async def add_log(room_id, message, color='white', type='system'):
+# 流量限制（見 ratelimit.py）：每條連線、每個房間各一份預算，格式 "事件=每秒次數/最多連發"，
+# 以 RATE_LIMITS / ROOM_RATE_LIMITS 覆寫，例如 RATE_LIMITS="send_chat=1/3"；連線與斷線不受限制
+# 'throttled' 是被擋下時回覆提示本身的預算，避免洗頻的人再換來一樣多的回覆
+SID_BUDGETS = ratelimit.parse_budgets(os.environ.get("RATE_LIMITS", ""), {
+    '*': (10, 20), 'join_room': (1, 5), 'send_chat': (2, 6), 'toggle_ready': (2, 4), 'update_settings': (2, 5),
+    'set_first_leader': (2, 5), 'kick_player': (1, 3), 'request_reset': (1, 3), 'request_state': (2, 5),
+    'fetch_history': (4, 10), 'list_rooms': (1, 5), 'throttled': (0.2, 1),
+})
+ROOM_BUDGETS = ratelimit.parse_budgets(os.environ.get("ROOM_RATE_LIMITS", ""), {
+    '*': (50, 100), 'send_chat': (10, 30), 'toggle_ready': (10, 20),
+})
+UNLIMITED_EVENTS = ('connect', 'disconnect')
+CHAT_MAX_LENGTH = int(os.environ.get("CHAT_MAX_LENGTH", 500))
+CHAT_MERGE_LIMIT = int(os.environ.get("CHAT_MERGE_LIMIT", 10))
+
+# 房間持久化：設定 AVALON_DATA_DIR（例如 data）才開啟，journal 與快照寫在該目錄；SNAPSHOT_INTERVAL 秒寫一次快照
+DATA_DIR = os.environ.get("AVALON_DATA_DIR", "")
+SNAPSHOT_INTERVAL = int(os.environ.get("SNAPSHOT_INTERVAL", 60))
+if DATA_DIR and node: DATA_DIR = os.path.join(DATA_DIR, f"worker-{node.id}")
+journal = persistence.Journal(DATA_DIR, snapshot_interval=SNAPSHOT_INTERVAL) if DATA_DIR else None
+
+# 只有 STATIC_DIR 底下的檔案會對外服務，啟動時由 assets.build 建好壓縮版與帶雜湊的網址
+STATIC_DIR = os.environ.get("STATIC_DIR", os.path.join(os.path.dirname(os.path.abspath(__file__)), "static"))
+site = None
+
+rooms = {}
+# sid -> (room_id, token)，讓所有事件 O(1) 找到呼叫者所在房間與身分，不信任 payload 裡的 room_id
+sid_index = {}
+# room_id -> 最後活動時間，依時間排序，回收時從最舊的開始掃，遇到還沒過期的就停
+room_activity = OrderedDict()
+room_stats = {'evicted_rooms': 0, 'reclaimed_players': 0, 'reclaimed_messages': 0}
+room_actors = actors.Registry(ROOM_QUEUE_SIZE)
+sid_limits = ratelimit.Limiter(SID_BUDGETS)
+room_limits = ratelimit.Limiter(ROOM_BUDGETS)
+
+
+def add_log(room_id, message, color='white', type='system'):
     if room_id not in rooms: return
-    timestamp = datetime.now().strftime("%H:%M")
-    msg_data = {'time': timestamp, 'msg': message, 'color': color, 'type': type}
-    rooms[room_id]['chat_history'].append(msg_data)
-    await sio.emit('new_message', msg_data, room=room_id)
+    room = rooms[room_id]
+    touch_room(room_id)
+    timestamp = datetime.fromtimestamp(event_time or time.time()).strftime("%H:%M")
+    room.chat_seq += 1
+    msg_data = {'id': room.chat_seq, 'time': timestamp, 'msg': message, 'color': color, 'type': type}
+    room.chat_history.append(msg_data)
+    queue_emit(room_id, 'new_message', msg_data)
+
+
+# 所有事件處理都經過 event 註冊，統一先檢查流量預算，再排進房間 actor 並加上計時（計時包含排隊時間）
+def event(handler):
+    name = handler.__name__
+    handlers[name] = rate_limited(name, metrics.timed(name, in_room(name, handler)))
+    if node is None: return sio.on(name)(handlers[name])
+
+    async def routed(sid, *args):
+        await dispatch(name, sid, *args)
+    return sio.on(name)(routed)
+
+
+def event_room(name, sid, args):
+    if name == 'join_room': return str(args[0]['room_id']).strip()
+    return sid_index.get(sid, (None,))[0]
+
+
+# 超出預算的事件在排進房間 actor 之前就擋下，不佔佇列也不碰房間狀態
+# 先扣連線自己的預算再扣房間的，洗頻的連線用完自己的額度就停在這裡，不會吃掉同房其他人的額度
+def rate_limited(name, handler):
+    if name in UNLIMITED_EVENTS: return handler
+
+    async def wrapper(sid, *args):
+        room_id = event_room(name, sid, args)
+        if sid_limits.take(sid, name):
+            if room_id is None or room_limits.take(room_id, name): return await handler(sid, *args)
+            sid_limits.refund(sid, name)
+        metrics.events_throttled.inc(name)
+        if name == 'send_chat' and room_id is not None:
+            defer_chat(sid, room_id, handler, *args)
+        elif sid_limits.take(sid, 'throttled'):
+            await emit('busy', {'msg': '操作太頻繁，請稍後再試'}, to=sid)
+    return wrapper
+
+
+# 房間相關的事件排進該房間的 actor：同一房間一次只跑一個事件處理，中間的 await 不會被其他事件插隊
+def in_room(name, handler):
+    async def wrapper(sid, *args):
+        room_id = event_room(name, sid, args)
+        if room_id is None: return await handler(sid, *args)
+        try:
+            future = room_actors.submit(room_id, handler, sid, *args, force=name == 'disconnect')
+        except asyncio.QueueFull:
+            metrics.commands_dropped.inc(name)
+            await emit('busy', {'msg': '房間忙碌中，請稍後再試'}, to=sid)
+            return
+        return await future
+    return wrapper
+
+
+# === 指令日誌 ===
+# 改變房間狀態的部分都寫成 applier：同步、不做 I/O、隨機性只來自參數，時間取 event_time
+# commit 先把 (動作, 參數, 時間) 寫進 journal 再套用；重啟時用同一批 applier 重播，重播期間不送出任何事件
+# 連線相關的 sid / connected / 進出 socket.io 房間留在事件處理裡，不進 journal，還原後所有人視為離線
+appliers = {}
+replaying = False
+event_time = None
+
+
+def applier(fn):
+    appliers[fn.__name__[len('apply_'):]] = fn
+    return fn
+
+
+def commit(room_id, op, *args):
+    global event_time
+    event_time = time.time()
+    if journal:
+        journal.append(room_id, op, args, event_time)
+        dirty_rooms.add(room_id)
+    appliers[op](room_id, *args)
+
+
+async def emit(event, data, room=None, to=None):
+    # room 與 to 都沒給時 socket.io 會送給所有連線，一律擋下
+    if room is None and to is None:
+        logger.error("emit %s without a target", event)
+        return
+    started = time.perf_counter()
+    if to in sid_worker:
+        await node.bus.send(sid_worker[to], {'op': 'emit', 'ev': event, 'data': data, 'to': to})
+    else:
+        await send_local(event, data, room=room, to=to)
+        if room and sid_worker:
+            for worker in room_workers(room):
+                await node.bus.send(worker, {'op': 'emit', 'ev': event, 'data': data, 'room': room})
+    elapsed = time.perf_counter() - started
+    if to:
+        recipients = 1
+    else:
+        target, spectators = group_room(room)
+        recipients = 0 if target is None else target.online_spectators if spectators else target.online_players
+    metrics.record_emit(event, elapsed)
+    # batch 依內含的事件分別記錄大小，才看得出 state_patch / new_message 各佔多少
+    for name, payload in (data if event == 'batch' else [(event, data)]):
+        metrics.record_payload(name, payload, recipients)
+
+
+# === 合併送出 ===
+# 同一個事件循環 tick 內對同一房間的事件先放進 outbox，下一個 tick 依序合併成一個 batch 封包送出
+outbox = {}
+flush_tasks = set()
+
+
+def queue_emit(room_id, event, data):
+    if replaying: return
+    pending = outbox.get(room_id)
+    if pending is None:
+        pending = outbox[room_id] = []
+        task = asyncio.create_task(flush_outbox(room_id))
+        flush_tasks.add(task)
+        task.add_done_callback(flush_tasks.discard)
+    pending.append([event, data])
+    if event != 'state_patch': queue_spectators(room_id, event, data)
+
+
+async def flush_outbox(room_id):
+    events = outbox.pop(room_id, None)
+    if not events: return
+    if len(events) == 1:
+        await emit(events[0][0], events[0][1], room=room_id)
+    else:
+        await emit('batch', events, room=room_id)
+
+
+# === 多程序分片 ===
+# routes：本 worker 上的連線目前在哪個房間，決定事件要交給哪個 worker
+# sid_worker：房間擁有者記錄「不在本機的連線」在哪個 worker，送給它們的訊息與進出房間都經由 bus
+# 單程序時兩者都是空的，所有呼叫直接走本機 socket.io
+handlers = {}
+routes = {}
+sid_worker = {}
+bus_tasks = set()
+
+
+async def dispatch(name, sid, *args):
+    if name == 'join_room':
+        room_id = str(args[0]['room_id']).strip()
+        prev = routes.get(sid)
+        # 換到別的 worker 的房間時，舊房間的擁有者要先把這條連線當成離線處理
+        if prev is not None and node.owner(prev) != node.owner(room_id):
+            await run_on_owner(prev, 'disconnect', sid)
+        routes[sid] = room_id
+    elif name == 'disconnect':
+        room_id = routes.pop(sid, None)
+    else:
+        room_id = routes.get(sid)
+    await run_on_owner(room_id, name, sid, *args)
+
+
+async def run_on_owner(room_id, name, sid, *args):
+    owner = node.id if room_id is None else node.owner(room_id)
+    if owner == node.id:
+        await handlers[name](sid, *args)
+    else:
+        await node.bus.send(owner, {'op': 'event', 'ev': name, 'sid': sid, 'args': args, 'from': node.id})
+
+
+async def run_forwarded(name, sid, args):
+    try:
+        await handlers[name](sid, *args)
+    except Exception:
+        logger.exception("forwarded %s failed", name)
+    finally:
+        if name == 'disconnect': sid_worker.pop(sid, None)
+
+
+async def on_bus_message(msg):
+    op = msg['op']
+    if op == 'event':
+        sid_worker[msg['sid']] = msg['from']
+        task = asyncio.create_task(run_forwarded(msg['ev'], msg['sid'], msg['args']))
+        bus_tasks.add(task)
+        task.add_done_callback(bus_tasks.discard)
+    elif op == 'emit':
+        await send_local(msg['ev'], msg['data'], room=msg.get('room'), to=msg.get('to'))
+    elif op == 'enter':
+        await sio.enter_room(msg['sid'], wire_group(msg['sid'], msg['room']))
+    elif op == 'leave':
+        await sio.leave_room(msg['sid'], wire_group(msg['sid'], msg['room']))
+    elif op == 'close_room':
+        await close_local(msg['room'])
+    elif op == 'lobby':
+        merge_lobby(msg['entries'])
+    elif op == 'lobby_sync':
+        for room_id in [r for r in lobby_index.entries if node.owner(r) == msg['from']]: lobby_index.remove(room_id)
+        merge_lobby(msg['entries'])
+        if msg['reply']: await node.bus.send(msg['from'], lobby_sync_message(reply=False))
+
+
+def room_workers(group):
+    room, _ = group_room(group)
+    if room is None: return set()
+    return {sid_worker[p.sid] for p in room.players.values() if p.connected and p.sid in sid_worker}
+
+
+async def enter_room(sid, room_id):
+    if sid in sid_worker:
+        await node.bus.send(sid_worker[sid], {'op': 'enter', 'sid': sid, 'room': room_id})
+    else:
+        await sio.enter_room(sid, wire_group(sid, room_id))
+
+
+async def leave_room(sid, room_id):
+    if sid in sid_worker:
+        await node.bus.send(sid_worker[sid], {'op': 'leave', 'sid': sid, 'room': room_id})
+    else:
+        await sio.leave_room(sid, wire_group(sid, room_id))
+
+
+async def close_room(group):
+    await close_local(group)
+    if node:
+        for worker in node.peers: await node.bus.send(worker, {'op': 'close_room', 'room': group})
+
+
+# === 精簡傳輸格式 ===
+# 連線時在 auth 選用 codec.NAME 的連線標記在 environ 裡，斷線時跟著 environ 一起消失
+# 它們加入的是 codec.group(群組) 而不是原本的群組，所以每次送出只需各編碼一次：JSON 一份、msgpack 一份
+# 編碼發生在連線所在的 worker，bus 上傳的一律是原始資料
+@event
+async def connect(sid, environ, auth=None):
+    if codec.available and isinstance(auth, dict) and auth.get('codec') == codec.NAME:
+        environ['avalon.compact'] = True
+
+
+def is_compact(sid):
+    environ = sio.get_environ(sid)
+    return bool(environ and environ.get('avalon.compact'))
+
+
+def wire_group(sid, group):
+    return codec.group(group) if is_compact(sid) else group
+
+
+async def send_local(event, data, room=None, to=None):
+    if to:
+        await sio.emit(event, codec.encode(event, data) if is_compact(to) else data, to=to)
+        return
+    groups = sio.manager.rooms.get('/', {})
+    if room in groups: await sio.emit(event, data, room=room)
+    if codec.group(room) in groups: await sio.emit(event, codec.encode(event, data), room=codec.group(room))
+
+
+async def close_local(group):
+    await sio.close_room(group)
+    await sio.close_room(codec.group(group))
+
+
+# === 觀戰者 ===
+# 觀戰者在另一個 socket.io 群組，不跟玩家一起即時收每個事件：房間有變動時只做標記，
+# 每 1/SPECTATOR_HZ 秒把累積的事件加上一份觀戰用狀態差異合成一個 batch 送給整個群組
+# 玩家這邊的送出量與延遲因此跟觀眾人數無關；觀戰狀態有自己的版本號，與玩家的 v 互不相干
+SPECTATOR_HZ = float(os.environ.get("SPECTATOR_HZ", 2))
+# room_id -> 等待送給觀戰者的 [event, data]；有 key 就代表該房間需要在下一輪更新
+spectator_outbox = {}
+
+
+# 房號都經過 strip()，不可能以空白開頭，所以觀戰群組不會跟任何房間撞名
+def spectator_group(room_id):
+    return ' spectators:' + room_id
+
+
+def player_group(room_id, p):
+    return spectator_group(room_id) if p.is_spectator else room_id
+
+
+# 回傳 (房間, 是否為觀戰群組)
+def group_room(group):
+    if group.startswith(' spectators:'): return rooms.get(group[len(' spectators:'):]), True
+    return rooms.get(group), False
+
+
+def has_spectators(room):
+    return room.online_spectators > 0
+
+
+# 沒人觀戰時 flush_spectators 不會推進 spectator_synced，狀態一變就把它作廢，下一個觀眾加入時重建
+def queue_spectators(room_id, event=None, data=None):
+    room = rooms.get(room_id)
+    if room is None: return
+    if not has_spectators(room):
+        room.spectator_synced = None
+        return
+    pending = spectator_outbox.setdefault(room_id, [])
+    if event: pending.append([event, data])
+
+
+def spectator_state(room):
+    data = build_state(room)
+    for p in data['players']: del p['has_reset_voted']
+    return data
+
+
+def spectator_snapshot(room):
+    # 直接沿用上一輪送出的觀戰狀態，大量觀眾同時加入也不必逐一重算
+    # 之後的改變都已排進 spectator_outbox，下一輪送出的差異正是從這份狀態算起；作廢了就當場重建
+    if room.spectator_synced is None: room.spectator_synced = remember_state(spectator_state(room))
+    synced = room.spectator_synced
+    hist, length = synced['game_history_ref']
+    data = {k: v for k, v in synced.items() if k != 'game_history_ref'}
+    data['game_history'] = hist[:length]
+    data['chat_history'], data['chat_has_more'] = chat_page(room)
+    data['v'] = room.spectator_version
+    return data
+
+
+async def flush_spectators():
+    global spectator_outbox
+    pending, spectator_outbox = spectator_outbox, {}
+    for room_id, events in pending.items():
+        room = rooms.get(room_id)
+        if room is None or not has_spectators(room): continue
+        data = spectator_state(room)
+        patch = state_patch(room.spectator_synced, data)
+        room.spectator_synced = remember_state(data)
+        if patch:
+            room.spectator_version += 1
+            patch['v'] = room.spectator_version
+            events.append(['state_patch', patch])
+        if events: await emit('batch', events, room=spectator_group(room_id))
+
+
+async def spectator_ticker():
+    while True:
+        await asyncio.sleep(1 / SPECTATOR_HZ)
+        try:
+            await flush_spectators()
+        except Exception:
+            logger.exception("spectator flush failed")
+
+
+# === 大廳目錄 ===
+# 房間摘要的二級索引（見 lobby.py），每次 broadcast_state 與回收房間時增量更新，列表查詢不必掃過 rooms
+# 多 worker 時每個 worker 都保有全部房間的摘要：擁有者把有變動的摘要每個 tick 合併一次經由 bus 發給其他 worker，
+# worker 啟動（包含被重啟）時與其他 worker 互相交換自己擁有的全部摘要
+LOBBY_PAGE_SIZE = 20
+LOBBY_PAGE_LIMIT = 100
+lobby_index = lobby.Directory(max(engine.BALANCE_CONFIG))
+lobby_outbox = set()
+
+
+def index_room(room_id):
+    room = rooms.get(room_id)
+    if room is None:
+        changed = lobby_index.remove(room_id)
+    else:
+        players = room.active_count
+        changed = lobby_index.update(room_id, room.state, players, len(room.players) - players)
+    # 重播時 bus 還沒啟動，之後的 sync_lobby 會送出完整的一份
+    if changed and node and not replaying:
+        if not lobby_outbox:
+            task = asyncio.create_task(flush_lobby())
+            flush_tasks.add(task)
+            task.add_done_callback(flush_tasks.discard)
+        lobby_outbox.add(room_id)
+
+
+async def flush_lobby():
+    entries = {room_id: lobby_index.entries.get(room_id) for room_id in lobby_outbox}
+    lobby_outbox.clear()
+    for worker in node.peers: await node.bus.send(worker, {'op': 'lobby', 'entries': entries})
+
+
+def merge_lobby(entries):
+    for room_id, entry in entries.items():
+        if entry is None:
+            lobby_index.remove(room_id)
+        else:
+            lobby_index.update(room_id, *entry)
+
+
+def lobby_sync_message(reply):
+    entries = {room_id: entry for room_id, entry in lobby_index.entries.items() if node.owner(room_id) == node.id}
+    return {'op': 'lobby_sync', 'from': node.id, 'entries': entries, 'reply': reply}
+
+
+async def sync_lobby():
+    for worker in node.peers:
+        try:
+            await node.bus.send(worker, lobby_sync_message(reply=True))
+        except OSError:
+            logger.warning("lobby sync with worker %d failed", worker)
+
+
+def query_lobby(states=None, min_players=0, max_players=None, min_open_seats=0, after=None, limit=LOBBY_PAGE_SIZE):
+    return lobby_index.query(states=states, min_players=max(0, min_players), max_players=max_players,
+                             min_open_seats=max(0, min_open_seats), after=after,
+                             limit=max(1, min(limit, LOBBY_PAGE_LIMIT)))
+
+
+# GET /api/rooms?state=LOBBY&min_open_seats=1&limit=20，下一頁帶 after=<上一頁回傳的 next>
+@app.get("/api/rooms")
+async def list_rooms_endpoint(state: list[str] = Query(None), min_players: int = 0, max_players: int = None,
+                              min_open_seats: int = 0, after: str = None, limit: int = LOBBY_PAGE_SIZE):
+    return query_lobby(state, min_players, max_players, min_open_seats, after, limit)
+
+
+# 客戶端送來的值可能是任何型別，轉不成整數就當沒帶
+def to_int(value, default):
+    try:
+        return default if value is None else int(value)
+    except (TypeError, ValueError, OverflowError):
+        return default
+
+
+@event
+async def list_rooms(sid, data=None):
+    if not isinstance(data, dict): data = {}
+    states = data.get('state')
+    if isinstance(states, str): states = [states]
+    elif not isinstance(states, list): states = None
+    after = data.get('after')
+    page = query_lobby(states, to_int(data.get('min_players'), 0), to_int(data.get('max_players'), None),
+                       to_int(data.get('min_open_seats'), 0), None if after is None else str(after),
+                       to_int(data.get('limit'), LOBBY_PAGE_SIZE))
+    await emit('room_list', page, to=sid)
+
+
+def touch_room(room_id):
+    room_activity[room_id] = time.monotonic()
+    room_activity.move_to_end(room_id)
+
+
+def chat_page(room, before_id=None, limit=CHAT_SNAPSHOT_SIZE):
+    history = room.chat_history
+    if not history: return [], False
+    first_id = history[0]['id']
+    end = len(history) if before_id is None else max(0, min(len(history), before_id - first_id))
+    start = max(0, end - limit)
+    return list(islice(history, start, end)), start > 0
+
+
+def get_session(sid):
+    entry = sid_index.get(sid)
+    if not entry: return None, None, None
+    room_id, token = entry
+    room = rooms.get(room_id)
+    if not room or token not in room.players: return None, None, None
+    return room_id, room, token
 
 
 def get_host_token(room):
-    active_candidates = [p for p in room['players'].values() if p['connected'] and p['role'] != 'spectator']
-    if not active_candidates: return None
-    sorted_candidates = sorted(active_candidates, key=lambda x: x['join_time'])
-    return sorted_candidates[0]['token']
+    for token in room.seats:
+        if room.players[token].connected: return token
+    return None
 
 
-async def broadcast_state(room_id):
-    room = rooms[room_id]
+def build_state(room):
     players_list = []
 
-    active_tokens = [k for k, v in room['players'].items() if v['role'] != 'spectator']
-    sorted_tokens = sorted(active_tokens, key=lambda t: room['players'][t]['join_time'])
-
-    for idx, token in enumerate(sorted_tokens):
-        p = room['players'][token]
+    for idx, token in enumerate(room.seats):
+        p = room.players[token]
         has_voted = False
-        if room['state'] == GameState.TEAM_VOTING:
-            has_voted = token in room['votes']
-        elif room['state'] == GameState.MISSION:
-            has_voted = token in room['mission_votes_who']
+        if room.state == GameState.TEAM_VOTING:
+            has_voted = token in room.votes
+        elif room.state == GameState.MISSION:
+            has_voted = token in room.mission_votes_who
 
         players_list.append({
-            'token': token, 'name': p['name'], 'avatar': p['avatar'],
-            'is_leader': idx == room['leader_index'],
-            'is_first_leader': token == room.get('first_leader_token'),
-            'in_team': token in room['current_team'],
-            'has_voted': has_voted, 'is_connected': p['connected'],
-            'has_reset_voted': token in room['reset_votes'],
-            'is_ready': p.get('is_ready', False),
+            'token': token, 'name': p.name, 'avatar': p.avatar,
+            'is_leader': idx == room.leader_index,
+            'is_first_leader': token == room.first_leader_token,
+            'in_team': token in room.team_set,
+            'has_voted': has_voted, 'is_connected': p.connected,
+            'has_reset_voted': token in room.reset_votes,
+            'is_ready': p.is_ready,
             'role_type': 'player'
         })
 
     current_host = get_host_token(room)
-    required = 0
-    try:
-        required = QUEST_CONFIG[len(sorted_tokens)][room['quest_index']]
-    except:
-        pass
+    required = engine.team_size(room.active_count, room.quest_index)
 
     revealed_roles = {}
-    if room['state'] == GameState.GAME_OVER:
-        for t, p in room['players'].items():
-            if p['role'] and p['role'] != 'spectator':
-                revealed_roles[t] = p['role']
-
-    data = {
-        'state': room['state'], 'players': players_list,
-        'quest_results': room['quest_results'], 'quest_idx': room['quest_index'],
-        'team_size_needed': required, 'vote_track': room['vote_track'],
-        'settings': room['settings'],
-        'game_history': room.get('game_history', []),
-        'chat_history': room.get('chat_history', []),
+    if room.state == GameState.GAME_OVER:
+        for t, p in room.players.items():
+            if p.role and p.role != 'spectator':
+                revealed_roles[t] = p.role
+
+    return {
+        'state': room.state, 'players': players_list,
+        'quest_results': list(room.quest_results), 'quest_idx': room.quest_index,
+        'team_size_needed': required, 'vote_track': room.vote_track,
+        'settings': dict(room.settings),
+        'game_history': room.game_history,
         'host_token': current_host,
         'revealed_roles': revealed_roles
     }
-    await sio.emit('update_state', data, room=room_id)
 
 
-@sio.event
+# === 差異同步 ===
+# 每次狀態變動版本號 +1，只送出變動的欄位；客戶端發現版本跳號時以 request_state 要求完整快照
+def diff_state(prev, data):
+    patch = {}
+    changed = {}
+    for k, v in data.items():
+        if k in ('players', 'game_history'): continue
+        if prev.get(k) != v: changed[k] = v
+    if changed: patch['set'] = changed
+
+    old_players, new_players = prev['players'], data['players']
+    if [p['token'] for p in old_players] != [p['token'] for p in new_players]:
+        patch['players'] = new_players
+    else:
+        player_patch = {}
+        for old, new in zip(old_players, new_players):
+            fields = {k: v for k, v in new.items() if old.get(k) != v}
+            if fields: player_patch[new['token']] = fields
+        if player_patch: patch['player_patch'] = player_patch
+
+    # game_history 只會追加，換局時整份替換
+    old_hist, old_len = prev['game_history_ref']
+    new_hist = data['game_history']
+    if new_hist is old_hist and len(new_hist) >= old_len:
+        if len(new_hist) > old_len: patch['append'] = {'game_history': new_hist[old_len:]}
+    else:
+        patch.setdefault('set', {})['game_history'] = new_hist
+    return patch
+
+
+def remember_state(data):
+    data['game_history_ref'] = (data['game_history'], len(data['game_history']))
+    return data
+
+
+def state_patch(prev, data):
+    if prev is None: return {'set': {k: v for k, v in data.items() if k != 'players'}, 'players': data['players']}
+    return diff_state(prev, data)
+
+
+def broadcast_state(room_id):
+    room = rooms[room_id]
+    touch_room(room_id)
+    # 重播時不送出也不推進版本號：版本號只對當下的連線有意義，重啟後每個人都會重新加入、拿完整快照
+    if replaying:
+        index_room(room_id)
+        return
+    data = build_state(room)
+    patch = state_patch(room.synced_state, data)
+    index_room(room_id)
+    # 狀態沒變就不推進版本也不送出，觀戰狀態同源，一樣不用排
+    if not patch: return
+    room.synced_state = remember_state(data)
+    room.version += 1
+    patch['v'] = room.version
+    queue_emit(room_id, 'state_patch', patch)
+    queue_spectators(room_id)
+
+
+async def send_snapshot(sid, room_id):
+    room = rooms[room_id]
+    entry = sid_index.get(sid)
+    p = room.players.get(entry[1]) if entry else None
+    if p and p.is_spectator:
+        await emit('update_state', spectator_snapshot(room), to=sid)
+        return
+    data = build_state(room)
+    data['chat_history'], data['chat_has_more'] = chat_page(room)
+    data['v'] = room.version
+    await emit('update_state', data, to=sid)
+
+
+@event
+async def request_state(sid, _room_id=None):
+    room_id, room, token = get_session(sid)
+    if not room: return
+    await send_snapshot(sid, room_id)
+
+
+@event
+async def fetch_history(sid, data=None):
+    room_id, room, token = get_session(sid)
+    if not room: return
+    if not isinstance(data, dict): data = {}
+    limit = max(1, min(to_int(data.get('limit'), CHAT_SNAPSHOT_SIZE), CHAT_PAGE_LIMIT))
+    messages, has_more = chat_page(room, to_int(data.get('before_id'), None), limit)
+    await emit('history_page', {'messages': messages, 'has_more': has_more}, to=sid)
+
+
+@event
 async def join_room(sid, data):
     name = data['name'];
     room_id = str(data['room_id']).strip();
     avatar = data['avatar'];
     token = data.get('token')
 
+    # 同一條連線換房（或在同房換成新身分）時，先離開舊的位子；舊房的狀態變動排進舊房的 actor，
+    # 不等它做完，兩條連線同時往對方的房間換時才不會互相等待
+    prev = sid_index.get(sid)
+    if prev and prev != (room_id, token):
+        entry = await leave_current_room(sid)
+        if entry: room_actors.submit(entry[0], mark_offline, sid, *entry, force=True).add_done_callback(log_failure)
+    # 排隊期間連線可能已經斷了，斷線處理找不到這次加入，加入了會留下永遠在線的玩家
+    if is_gone(sid): return
+
+    room = rooms.get(room_id)
+    if room and token and token in room.players:
+        commit(room_id, 'rejoin', token, name, avatar)
+        p = room.players[token]
+    else:
+        token = str(uuid.uuid4())
+        commit(room_id, 'join', token, name, avatar)
+        room = rooms[room_id]
+        p = room.players[token]
+    p.sid = sid
+    sid_index[sid] = (room_id, token)
+    await enter_room(sid, player_group(room_id, p))
+    await emit('join_success', {'token': token, 'is_spectator': p.is_spectator}, to=sid)
+    if room.state != GameState.LOBBY and p.role and not p.is_spectator:
+        await send_role_info(sid, room, token)
+    await send_snapshot(sid, room_id)
+
+
+@applier
+def apply_join(room_id, token, name, avatar):
     if room_id not in rooms:
-        rooms[room_id] = {
-            'players': {}, 'sid_map': {}, 'state': GameState.LOBBY,
-            'quest_results': [None] * 5, 'quest_index': 0, 'leader_index': 0,
-            'current_team': [], 'votes': {}, 'mission_votes': [], 'mission_votes_who': [],
-            'vote_track': 0, 'chat_history': [], 'reset_votes': set(), 'game_history': [],
-            'first_leader_token': None,
-            'settings': {'merlin': True, 'percival': True, 'assassin': True, 'morgana': True, 'mordred': False,
-                         'oberon': False}
-        }
+        rooms[room_id] = Room(room_id, chat_limit=CHAT_HISTORY_LIMIT)
     room = rooms[room_id]
+    is_spectator = room.state != GameState.LOBBY
+    role = 'spectator' if is_spectator else None
+    room.add_player(Player(token, name, avatar, None, role, event_time or time.time()))
 
-    is_spectator = False
-    if room['state'] != GameState.LOBBY and (not token or token not in room['players']):
-        is_spectator = True
-
-    if token and token in room['players']:
-        p = room['players'][token];
-        p['sid'] = sid;
-        p['connected'] = True;
-        room['sid_map'][sid] = token;
-        p['name'] = name;
-        p['avatar'] = avatar
-        await sio.enter_room(sid, room_id)
-        await sio.emit('join_success', {'token': token, 'is_spectator': p['role'] == 'spectator'}, to=sid)
-        await add_log(room_id, f"⚡ {name} 重連", "#aaa")
-        if room['state'] != GameState.LOBBY and p['role'] and p['role'] != 'spectator':
-            await send_role_info(sid, p, list(room['players'].values()))
+    if not room.first_leader_token and not is_spectator:
+        room.first_leader_token = token
+
+    if is_spectator:
+        add_log(room_id, f"👻 {name} 旁觀中", "#888")
     else:
-        new_token = str(uuid.uuid4())
-        role = 'spectator' if is_spectator else None
-        room['players'][new_token] = {'token': new_token, 'name': name, 'avatar': avatar, 'sid': sid, 'role': role,
-                                      'join_time': datetime.now().timestamp(), 'connected': True, 'is_ready': False}
-        room['sid_map'][sid] = new_token
-        await sio.enter_room(sid, room_id)
-
-        if not room['first_leader_token'] and not is_spectator:
-            room['first_leader_token'] = new_token
-
-        if is_spectator:
-            await sio.emit('join_success', {'token': new_token, 'is_spectator': True}, to=sid)
-            await add_log(room_id, f"👻 {name} 旁觀中", "#888")
-        else:
-            await sio.emit('join_success', {'token': new_token, 'is_spectator': False}, to=sid)
-            await add_log(room_id, f"👋 {name} 加入", "#aaa")
+        add_log(room_id, f"👋 {name} 加入", "#aaa")
+    broadcast_state(room_id)
 
-    await broadcast_state(room_id)
 
+@applier
+def apply_rejoin(room_id, token, name, avatar):
+    room = rooms[room_id]
+    room.set_connected(token, True)
+    p = room.players[token]
+    p.name = name;
+    p.avatar = avatar
+    add_log(room_id, f"⚡ {name} 重連", "#aaa")
+    broadcast_state(room_id)
+
+
+# 不 await 的 actor 指令用這個收結果，出錯時記下來，而不是留給 asyncio 報 "never retrieved"
+def log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error("room command failed", exc_info=future.exception())
 
-@sio.event
-async def disconnect(sid):
-    for room_id, room in rooms.items():
-        if sid in room['sid_map']:
-            token = room['sid_map'][sid]
-            if token in room['players']:
-                room['players'][token]['connected'] = False
-                await broadcast_state(room_id)
-            break
 
+# 本機連線已經斷線或正在斷線；其他 worker 上的連線由該 worker 轉送的 disconnect 處理
+def is_gone(sid):
+    return sid not in sid_worker and not sio.manager.is_connected(sid, '/')
 
-@sio.event
+
+# 連線立刻離開房間的 socket.io 群組；回傳 (房號, token) 讓呼叫端在該房間的 actor 裡呼叫 mark_offline
+async def leave_current_room(sid):
+    entry = sid_index.pop(sid, None)
+    if not entry: return None
+    room_id, token = entry
+    room = rooms.get(room_id)
+    if not room: return None
+    p = room.players.get(token)
+    await leave_room(sid, player_group(room_id, p) if p else room_id)
+    return entry if p else None
+
+
+async def mark_offline(sid, room_id, token):
+    room = rooms.get(room_id)
+    p = room.players.get(token) if room else None
+    # 玩家已經用新的連線重連就不動
+    if p is None or p.sid != sid or not p.connected: return
+    room.set_connected(token, False)
+    broadcast_state(room_id)
+
+
+@event
+async def disconnect(sid, reason=None):
+    sid_limits.forget(sid)
+    chat_pending.pop(sid, None)
+    entry = await leave_current_room(sid)
+    if entry: await mark_offline(sid, *entry)
+
+
+@event
 async def kick_player(sid, data):
-    room_id = data['room_id'];
     target_token = data['target_token']
-    room = rooms.get(room_id)
+    room_id, room, token = get_session(sid)
     if not room: return
-    if room['sid_map'].get(sid) != get_host_token(room): return
-    if target_token not in room['players']: return
-    target_p = room['players'][target_token]
-    if target_p['connected']: await sio.emit('kicked', {'msg': '你已被房主踢出房間'}, to=target_p['sid'])
-    del room['players'][target_token]
-    if target_p['sid'] in room['sid_map']: del room['sid_map'][target_p['sid']]
-    if room['first_leader_token'] == target_token: room['first_leader_token'] = None
-    await add_log(room_id, f"🚫 {target_p['name']} 被房主踢出", "red")
-    await broadcast_state(room_id)
-
-
-@sio.event
+    if token != get_host_token(room): return
+    if target_token not in room.players: return
+    target_p = room.players[target_token]
+    if target_p.connected: await emit('kicked', {'msg': '你已被房主踢出房間'}, to=target_p.sid)
+    if sid_index.get(target_p.sid) == (room_id, target_token):
+        del sid_index[target_p.sid]
+        await leave_room(target_p.sid, player_group(room_id, target_p))
+    commit(room_id, 'kick', target_token)
+
+
+@applier
+def apply_kick(room_id, target_token):
+    room = rooms[room_id]
+    target_p = room.remove_player(target_token)
+    if room.first_leader_token == target_token: room.first_leader_token = None
+    add_log(room_id, f"🚫 {target_p.name} 被房主踢出", "red")
+    broadcast_state(room_id)
+
+
+@event
 async def update_settings(sid, data):
-    room_id = data['room_id'];
     new_settings = data['settings'];
-    room = rooms.get(room_id)
-    if not room or room['state'] != GameState.LOBBY: return
-    if room['sid_map'].get(sid) != get_host_token(room): return
-    room['settings'] = new_settings
-    await broadcast_state(room_id)
+    room_id, room, token = get_session(sid)
+    if not room or room.state != GameState.LOBBY: return
+    if token != get_host_token(room): return
+    commit(room_id, 'settings', new_settings)
 
 
-@sio.event
+@applier
+def apply_settings(room_id, new_settings):
+    rooms[room_id].settings = new_settings
+    broadcast_state(room_id)
+
+
+@event
 async def set_first_leader(sid, data):
-    room_id = data['room_id'];
     target_token = data['target_token']
-    room = rooms.get(room_id)
-    if not room or room['state'] != GameState.LOBBY: return
-    if room['sid_map'].get(sid) != get_host_token(room): return
-    room['first_leader_token'] = target_token
-    await broadcast_state(room_id)
+    room_id, room, token = get_session(sid)
+    if not room or room.state != GameState.LOBBY: return
+    if token != get_host_token(room): return
+    commit(room_id, 'first_leader', target_token)
 
 
-@sio.event
-async def toggle_ready(sid, room_id):
-    if room_id not in rooms: return
-    room = rooms[room_id];
-    token = room['sid_map'].get(sid)
-    if not token or room['state'] != GameState.LOBBY: return
-    if room['players'][token]['role'] == 'spectator': return
-    room['players'][token]['is_ready'] = not room['players'][token].get('is_ready', False)
-    await broadcast_state(room_id)
+@applier
+def apply_first_leader(room_id, target_token):
+    rooms[room_id].first_leader_token = target_token
+    broadcast_state(room_id)
 
 
-@sio.event
-async def host_start_game(sid, room_id):
-    if room_id not in rooms: return
-    room = rooms[room_id]
-    if room['sid_map'].get(sid) != get_host_token(room): return
-    active_players = [p for p in room['players'].values() if p['role'] != 'spectator']
-    if not active_players or not all(p['is_ready'] for p in active_players): return
+@event
+async def toggle_ready(sid, _room_id=None):
+    room_id, room, token = get_session(sid)
+    if not room or room.state != GameState.LOBBY: return
+    if room.players[token].is_spectator: return
+    commit(room_id, 'ready', token)
+
+
+@applier
+def apply_ready(room_id, token):
+    p = rooms[room_id].players[token]
+    p.is_ready = not p.is_ready
+    broadcast_state(room_id)
+
+
+@event
+async def host_start_game(sid, _room_id=None):
+    room_id, room, token = get_session(sid)
+    if not room: return
+    if token != get_host_token(room): return
+    if not room.seats or not all(room.players[t].is_ready for t in room.seats): return
     await start_game_logic(room_id)
 
 
+# 發牌的隨機性只來自 seed，寫進 journal 後重播會得到同樣的身分與視野
 async def start_game_logic(room_id):
+    commit(room_id, 'start', rng.getrandbits(63))
+    room = rooms[room_id]
+    # 還原後還沒重連的玩家沒有 sid，等他重新加入時 join_room 會補送身分
+    for token in room.seats:
+        p = room.players[token]
+        if p.connected and p.sid: await send_role_info(p.sid, room, token)
+
+
+@applier
+def apply_start(room_id, seed):
     room = rooms[room_id]
-    active_tokens = [k for k, v in room['players'].items() if v['role'] != 'spectator']
-    sorted_tokens = sorted(active_tokens, key=lambda t: room['players'][t]['join_time'])
-    players_objs = [room['players'][t] for t in sorted_tokens]
-    cnt = len(players_objs)
-    settings = room['settings']
-    target_good, target_evil = BALANCE_CONFIG.get(cnt, (1, 0))
-    final_roles = []
-    if settings['merlin']: final_roles.append("梅林")
-    if settings['percival']: final_roles.append("派西維爾")
-    if settings['assassin']: final_roles.append("刺客")
-    if settings['morgana']: final_roles.append("莫甘娜")
-    if settings['mordred']: final_roles.append("莫德雷德")
-    if settings['oberon']: final_roles.append("奧伯倫")
-    current_good = len([r for r in final_roles if r in ["梅林", "派西維爾"]])
-    current_evil = len([r for r in final_roles if r in ["刺客", "莫甘娜", "莫德雷德", "奧伯倫"]])
-    for _ in range(max(0, target_good - current_good)): final_roles.append("忠臣")
-    for _ in range(max(0, target_evil - current_evil)): final_roles.append("壞人")
-    if len(final_roles) > cnt: final_roles = final_roles[:cnt]
-    while len(final_roles) < cnt: final_roles.append("忠臣")
-    random.shuffle(final_roles)
-    room['reset_votes'] = set();
-    room['state'] = GameState.TEAM_SELECTION
-    room['quest_index'] = 0;
-    room['vote_track'] = 0
-    room['quest_results'] = [None] * 5
-    room['game_history'] = []
-    if room.get('first_leader_token') and room['first_leader_token'] in sorted_tokens:
-        room['leader_index'] = sorted_tokens.index(room['first_leader_token'])
+    game_rng = random.Random(seed)
+    sorted_tokens = room.seats
+    players_objs = [room.players[t] for t in sorted_tokens]
+    final_roles = engine.deal_roles(room.settings, len(players_objs), game_rng)
+    room.reset_votes = set();
+    room.state = GameState.TEAM_SELECTION
+    room.quest_index = 0;
+    room.vote_track = 0
+    room.quest_results = [None] * 5
+    room.game_history = []
+    if room.first_leader_token and room.first_leader_token in room.players and \
+            not room.players[room.first_leader_token].is_spectator:
+        room.leader_index = sorted_tokens.index(room.first_leader_token)
     else:
-        room['leader_index'] = 0
-    for i, p_obj in enumerate(players_objs): p_obj['role'] = final_roles[i]
-    for p_obj in players_objs: await send_role_info(p_obj['sid'], p_obj, players_objs)
-    await add_log(room_id, f"🎲 本局身分牌: {', '.join(set(final_roles))}", "cyan")
-    await add_log(room_id, "🎮 遊戲開始！", "gold")
-    await broadcast_state(room_id)
+        room.leader_index = 0
+    for i, p_obj in enumerate(players_objs): room.set_role(p_obj.token, final_roles[i])
+    table = engine.visibility_table(final_roles, game_rng)
+    room.visibility = {t: [sorted_tokens[i] for i in table[seat]] for seat, t in enumerate(sorted_tokens)}
+    add_log(room_id, f"🎲 本局身分牌: {', '.join(sorted(set(final_roles)))}", "cyan")
+    add_log(room_id, "🎮 遊戲開始！", "gold")
+    broadcast_state(room_id)
 
 
-async def send_role_info(sid, p_obj, all_players):
-    my_role = p_obj['role']
-    info = {'role': my_role, 'teammates': []}
+# 能看到誰在發牌時就以 token 算好存在 room.visibility，開局與重連都只是查表
+async def send_role_info(sid, room, token):
+    my_role = room.players[token].role
     if my_role == 'spectator': return
-    evil_team_names = [p['name'] for p in all_players if p['role'] in ["莫甘娜", "刺客", "壞人", "莫德雷德", "奧伯倫"]]
-    if my_role in ["莫甘娜", "刺客", "壞人", "莫德雷德"]:
-        visible = []
-        for enemy_name in evil_team_names:
-            enemy_obj = next(p for p in all_players if p['name'] == enemy_name)
-            if enemy_obj['role'] != "奧伯倫" and enemy_obj['name'] != p_obj['name']: visible.append(enemy_name)
-        info['teammates'] = visible
-    elif my_role == "梅林":
-        visible = []
-        for enemy_name in evil_team_names:
-            enemy_obj = next(p for p in all_players if p['name'] == enemy_name)
-            if enemy_obj['role'] != "莫德雷德": visible.append(enemy_name)
-        info['teammates'] = visible
-    elif my_role == "派西維爾":
-        targets = [p['name'] for p in all_players if p['role'] in ["梅林", "莫甘娜"]]
-        random.shuffle(targets)
-        info['teammates'] = targets
-    await sio.emit('role_info', info, to=sid)
-
-
-@sio.event
+    teammates = [room.players[t].name for t in room.visibility.get(token, ()) if t in room.players]
+    info = {'role': my_role, 'teammates': teammates}
+    await emit('role_info', info, to=sid)
+
+
+@event
 async def send_chat(sid, data):
-    room_id = data['room_id'];
-    message = data['message']
-    room = rooms.get(room_id);
-    token = room['sid_map'].get(sid)
-    if room and token:
-        player_name = room['players'][token]['name']
-        await add_log(room_id, f"<b>{player_name}:</b> {message}", "#fff", "chat")
+    message = str(data['message'])[:CHAT_MAX_LENGTH]
+    room_id, room, token = get_session(sid)
+    if room: commit(room_id, 'chat', token, message)
 
 
-@sio.event
+# === 聊天洪水 ===
+# 超出預算的聊天先暫存，等連線與房間的 bucket 都補回 token 時合併成一則，照常經過房間 actor 與 journal 送出
+# 等待期間最多併入 CHAT_MERGE_LIMIT 則、合計不超過 CHAT_MAX_LENGTH 字，之後的直接丟掉；每條連線同時只有一則在等
+CHAT_SEPARATOR = '<br>'
+chat_pending = {}
+
+
+def defer_chat(sid, room_id, handler, data):
+    pending = chat_pending.get(sid)
+    if pending is None:
+        pending = chat_pending[sid] = []
+        task = asyncio.create_task(flush_chat(sid, room_id, handler))
+        flush_tasks.add(task)
+        task.add_done_callback(flush_tasks.discard)
+    message = str(data['message'])[:CHAT_MAX_LENGTH]
+    if pending and (len(pending) >= CHAT_MERGE_LIMIT or
+                    sum(map(len, pending)) + len(CHAT_SEPARATOR) * len(pending) + len(message) > CHAT_MAX_LENGTH):
+        metrics.chat_flood.inc('dropped')
+        return
+    metrics.chat_flood.inc('merged')
+    pending.append(message)
+
+
+# 房間的 bucket 是全房共用，醒來時可能已被別人的訊息用掉；兩個都拿到才送，否則繼續累積、再等一輪
+async def flush_chat(sid, room_id, handler):
+    while True:
+        await asyncio.sleep(max(sid_limits.wait(sid, 'send_chat'), room_limits.wait(room_id, 'send_chat')))
+        if sid not in chat_pending or sid_index.get(sid, (None,))[0] != room_id:
+            chat_pending.pop(sid, None)
+            return
+        if sid_limits.take(sid, 'send_chat'):
+            if room_limits.take(room_id, 'send_chat'): break
+            sid_limits.refund(sid, 'send_chat')
+    await handler(sid, {'message': CHAT_SEPARATOR.join(chat_pending.pop(sid))})
+
+
+@applier
+def apply_chat(room_id, token, message):
+    player_name = rooms[room_id].players[token].name
+    add_log(room_id, f"<b>{player_name}:</b> {message}", "#fff", "chat")
+
+
+# commit 會先把參數寫進 journal，不合法的隊伍要在這之前擋掉，否則每次重播都會再失敗一次
+def valid_team(room, team_tokens):
+    if not isinstance(team_tokens, list): return False
+    if len(team_tokens) != engine.team_size(room.active_count, room.quest_index): return False
+    if not all(isinstance(t, str) and t in room.players and not room.players[t].is_spectator for t in team_tokens):
+        return False
+    return len(set(team_tokens)) == len(team_tokens)
+
+
+@event
 async def select_team(sid, data):
-    room_id = data['room_id'];
     team_tokens = data['team'];
+    room_id, room, token = get_session(sid)
+    if not room or room.state != GameState.TEAM_SELECTION or token != room.leader_token: return
+    if not valid_team(room, team_tokens): return
+    commit(room_id, 'select_team', team_tokens)
+
+
+@applier
+def apply_select_team(room_id, team_tokens):
     room = rooms[room_id]
-    names = [room['players'][t]['name'] for t in team_tokens]
-    await add_log(room_id, f"👑 提議: {', '.join(names)}", "#4fc3f7")
-    room['current_team'] = team_tokens;
-    room['state'] = GameState.TEAM_VOTING;
-    room['votes'] = {}
-    await broadcast_state(room_id)
+    names = [room.players[t].name for t in team_tokens]
+    add_log(room_id, f"👑 提議: {', '.join(names)}", "#4fc3f7")
+    room.set_team(team_tokens);
+    room.state = GameState.TEAM_VOTING;
+    room.votes = {}
+    broadcast_state(room_id)
 
 
-@sio.event
+@event
 async def vote_team(sid, data):
-    room_id = data['room_id'];
     vote = data['vote'];
+    room_id, room, token = get_session(sid)
+    if not room: return
+    commit(room_id, 'vote_team', token, vote)
+
+
+@applier
+def apply_vote_team(room_id, token, vote):
     room = rooms[room_id]
-    token = room['sid_map'].get(sid)
-    if not token: return
-    room['votes'][token] = vote
-    active_players_count = len([p for p in room['players'].values() if p['role'] != 'spectator'])
-
-    if len(room['votes']) == active_players_count:
-        approves = list(room['votes'].values()).count(True);
-        rejects = list(room['votes'].values()).count(False);
-        passed = approves > rejects
-        active_tokens = [k for k, v in room['players'].items() if v['role'] != 'spectator']
-        sorted_tokens = sorted(active_tokens, key=lambda t: room['players'][t]['join_time'])
-        leader_token = sorted_tokens[room['leader_index']]
-        leader_name = room['players'][leader_token]['name']
-        history_entry = {'quest': room['quest_index'] + 1, 'leader': leader_name,
-                         'team': [room['players'][t]['name'] for t in room['current_team']],
-                         'votes': {room['players'][t]['name']: v for t, v in room['votes'].items()},
+    room.votes[token] = vote
+    active_players_count = room.active_count
+
+    if len(room.votes) == active_players_count:
+        approves, rejects, passed = engine.tally_votes(list(room.votes.values()))
+        leader_name = room.players[room.leader_token].name
+        history_entry = {'quest': room.quest_index + 1, 'leader': leader_name,
+                         'team': [room.players[t].name for t in room.current_team],
+                         'votes': {room.players[t].name: v for t, v in room.votes.items()},
                          'result': '通過' if passed else '否決', 'mission_result': None, 'fail_count': 0}
-        detail_str = " ".join([f"{room['players'][t]['name']}{'⭕' if v else '❌'}" for t, v in room['votes'].items()])
-        await sio.emit('vote_finished', {'details': detail_str, 'pass': passed}, room=room_id)
+        detail_str = " ".join([f"{room.players[t].name}{'⭕' if v else '❌'}" for t, v in room.votes.items()])
+        queue_emit(room_id, 'vote_finished', {'details': detail_str, 'pass': passed})
         if passed:
-            room['vote_track'] = 0;
-            room['state'] = GameState.MISSION;
-            room['mission_votes'] = [];
-            room['mission_votes_who'] = []
-            room['current_history_entry'] = history_entry
-            await add_log(room_id, f"✅ 通過 ({approves} vs {rejects})", "#66ff66")
+            room.vote_track = 0;
+            room.state = GameState.MISSION;
+            room.mission_votes = [];
+            room.mission_votes_who = set()
+            room.current_history_entry = history_entry
+            add_log(room_id, f"✅ 通過 ({approves} vs {rejects})", "#66ff66")
         else:
-            room['vote_track'] += 1;
-            room['leader_index'] = (room['leader_index'] + 1) % active_players_count;
-            room['state'] = GameState.TEAM_SELECTION
-            room['game_history'].append(history_entry)
-            await add_log(room_id, f"⚠️ 否決 ({approves} vs {rejects}) - 失敗: {room['vote_track']}", "#ff6666")
-            if room['vote_track'] >= 5: await add_log(room_id, "💀 5次流局，壞人勝！", "red"); room[
-                'state'] = GameState.GAME_OVER; await sio.emit('game_over', {'winner': 'RED (流局)'}, room=room_id)
-        await broadcast_state(room_id)
+            room.vote_track += 1;
+            room.leader_index = engine.next_leader(room.leader_index, active_players_count);
+            room.state = GameState.TEAM_SELECTION
+            room.game_history.append(history_entry)
+            add_log(room_id, f"⚠️ 否決 ({approves} vs {rejects}) - 失敗: {room.vote_track}", "#ff6666")
+            if room.vote_track >= engine.MAX_VOTE_TRACK:
+                add_log(room_id, "💀 5次流局，壞人勝！", "red"); room.state = GameState.GAME_OVER
+                queue_emit(room_id, 'game_over', {'winner': 'RED (流局)'})
+        broadcast_state(room_id)
 
 
-@sio.event
+@event
 async def vote_mission(sid, data):
-    room_id = data['room_id'];
     result = data['result'];
-    room = rooms[room_id];
-    token = room['sid_map'].get(sid)
-    if token in room['current_team'] and token not in room['mission_votes_who']: room['mission_votes'].append(result);
-    room['mission_votes_who'].append(token)
-    if len(room['mission_votes']) == len(room['current_team']):
-        fail_count = room['mission_votes'].count(False);
-        is_fail = fail_count >= 1
-        active_players_count = len([p for p in room['players'].values() if p['role'] != 'spectator'])
-        if active_players_count >= 7 and room['quest_index'] == 3: is_fail = fail_count >= 2
-        is_success = not is_fail
-
-        if 'current_history_entry' in room:
-            room['current_history_entry']['mission_result'] = "成功" if is_success else "失敗"
-            room['current_history_entry']['fail_count'] = fail_count
-            room['game_history'].append(room['current_history_entry'])
-            del room['current_history_entry']
-        room['quest_results'][room['quest_index']] = is_success
-
-        await sio.emit('mission_effect', {'success': is_success}, room=room_id)
+    room_id, room, token = get_session(sid)
+    if not room: return
+    commit(room_id, 'vote_mission', token, result)
+
+
+@applier
+def apply_vote_mission(room_id, token, result):
+    room = rooms[room_id]
+    if token in room.team_set and token not in room.mission_votes_who:
+        room.mission_votes.append(result)
+        room.mission_votes_who.add(token)
+    if len(room.mission_votes) == len(room.current_team):
+        active_players_count = room.active_count
+        is_success, fail_count = engine.mission_succeeded(room.mission_votes, active_players_count, room.quest_index)
+
+        if room.current_history_entry is not None:
+            room.current_history_entry['mission_result'] = "成功" if is_success else "失敗"
+            room.current_history_entry['fail_count'] = fail_count
+            room.game_history.append(room.current_history_entry)
+            room.current_history_entry = None
+        room.quest_results[room.quest_index] = is_success
+
+        queue_emit(room_id, 'mission_effect', {'success': is_success})
         log_icon = "🏆 聖杯" if is_success else "🍷 汙杯"
         log_color = "gold" if is_success else "red"
-        await add_log(room_id, f"🏁 R{room['quest_index'] + 1}: {log_icon} ({fail_count} 汙)", log_color)
+        add_log(room_id, f"🏁 R{room.quest_index + 1}: {log_icon} ({fail_count} 汙)", log_color)
 
-        room['quest_index'] += 1;
-        room['leader_index'] = (room['leader_index'] + 1) % active_players_count;
-        room['state'] = GameState.TEAM_SELECTION
-        wins = room['quest_results'].count(True);
-        losses = room['quest_results'].count(False)
-        if wins >= 3:
-            room['state'] = GameState.ASSASSINATION; await add_log(room_id, "🗡️ 藍方3勝！刺客現身", "#ef5350")
-        elif losses >= 3:
-            room['state'] = GameState.GAME_OVER; await add_log(room_id, "💀 紅方3勝！壞人勝", "#ef5350"); await sio.emit(
-                'game_over', {'winner': 'RED (任務失敗)'}, room=room_id)
+        room.quest_index += 1;
+        room.leader_index = engine.next_leader(room.leader_index, active_players_count);
+        room.state = GameState.TEAM_SELECTION
+        outcome = engine.quest_outcome(room.quest_results)
+        if outcome == 'ASSASSINATION':
+            room.state = GameState.ASSASSINATION; add_log(room_id, "🗡️ 藍方3勝！刺客現身", "#ef5350")
+        elif outcome == 'RED':
+            room.state = GameState.GAME_OVER; add_log(room_id, "💀 紅方3勝！壞人勝", "#ef5350")
+            queue_emit(room_id, 'game_over', {'winner': 'RED (任務失敗)'})
 
-        await broadcast_state(room_id)
+        broadcast_state(room_id)
 
 
-@sio.event
+@event
 async def assassinate(sid, data):
-    room_id = data['room_id'];
     target_token = data['target_token'];
+    room_id, room, token = get_session(sid)
+    if not room or room.state != GameState.ASSASSINATION or room.players[token].role != engine.ASSASSIN: return
+    target = room.players.get(target_token) if isinstance(target_token, str) else None
+    if target is None or target.is_spectator or target_token == token: return
+    commit(room_id, 'assassinate', target_token)
+
+
+@applier
+def apply_assassinate(room_id, target_token):
     room = rooms[room_id]
-    room['state'] = GameState.GAME_OVER;
-    target_role = room['players'][target_token]['role']
-    target_name = room['players'][target_token]['name']
-    await add_log(room_id, f"🗡️ 刺客殺了 {target_name} ({target_role})", "#ef5350")
-    if target_role == "梅林":
-        await add_log(room_id, "💀 梅林被殺！壞人勝！", "red"); await sio.emit('game_over', {'winner': 'RED (刺殺成功)'},
-                                                                            room=room_id)
+    target_role = room.players[target_token].role
+    target_name = room.players[target_token].name
+    room.state = GameState.GAME_OVER;
+    add_log(room_id, f"🗡️ 刺客殺了 {target_name} ({target_role})", "#ef5350")
+    if engine.assassination_succeeded(target_role):
+        add_log(room_id, "💀 梅林被殺！壞人勝！", "red"); queue_emit(room_id, 'game_over', {'winner': 'RED (刺殺成功)'})
     else:
-        await add_log(room_id, f"🛡️ 刺殺失敗！好人勝！", "gold"); await sio.emit('game_over',
-                                                                               {'winner': 'BLUE (刺殺失敗)'},
-                                                                               room=room_id)
-    await broadcast_state(room_id)
+        add_log(room_id, f"🛡️ 刺殺失敗！好人勝！", "gold"); queue_emit(room_id, 'game_over', {'winner': 'BLUE (刺殺失敗)'})
+    broadcast_state(room_id)
 
 
-@sio.event
-async def request_reset(sid, room_id):
-    if room_id not in rooms: return
-    room = rooms[room_id];
-    token = room['sid_map'].get(sid)
-    if token not in room['reset_votes']:
-        room['reset_votes'].add(token)
-        active_count = len([p for p in room['players'].values() if p['role'] != 'spectator'])
-        await add_log(room_id, f"⚠️ 請求重置 ({len(room['reset_votes'])}/{active_count})", "orange")
-        if len(room['reset_votes']) > active_count / 2:
-            room['state'] = GameState.LOBBY;
-            room['quest_results'] = [None] * 5;
-            room['quest_index'] = 0;
-            room['leader_index'] = 0
-            room['current_team'] = [];
-            room['votes'] = {};
-            room['mission_votes'] = [];
-            room['mission_votes_who'] = []
-            room['vote_track'] = 0;
-            room['reset_votes'] = set();
-            room['game_history'] = []
-            room['first_leader_token'] = None
-            for t in room['players']:
-                if room['players'][t]['role'] != 'spectator':
-                    room['players'][t]['role'] = None
-                    room['players'][t]['is_ready'] = False
-            await add_log(room_id, "🔄 遊戲已重置", "cyan")
-        await broadcast_state(room_id)
+@event
+async def request_reset(sid, _room_id=None):
+    room_id, room, token = get_session(sid)
+    if not room: return
+    if token not in room.reset_votes: commit(room_id, 'reset', token)
+
+
+@applier
+def apply_reset(room_id, token):
+    room = rooms[room_id]
+    room.reset_votes.add(token)
+    active_count = room.active_count
+    add_log(room_id, f"⚠️ 請求重置 ({len(room.reset_votes)}/{active_count})", "orange")
+    if len(room.reset_votes) > active_count / 2:
+        room.state = GameState.LOBBY;
+        room.quest_results = [None] * 5;
+        room.quest_index = 0;
+        room.leader_index = 0
+        room.set_team([]);
+        room.votes = {};
+        room.mission_votes = [];
+        room.mission_votes_who = set()
+        room.vote_track = 0;
+        room.reset_votes = set();
+        room.game_history = []
+        room.first_leader_token = None
+        room.visibility = {}
+        for t in room.seats:
+            room.players[t].role = None
+            room.players[t].is_ready = False
+        add_log(room_id, "🔄 遊戲已重置", "cyan")
+    broadcast_state(room_id)
+
+
+# === 閒置房間回收 ===
+def is_expired(room, idle):
+    if idle >= ROOM_IDLE_TTL and not room.online_players and not room.online_spectators:
+        return True
+    return idle >= ROOM_LOBBY_TTL and room.state in (GameState.LOBBY, GameState.GAME_OVER)
+
+
+async def evict_room(room_id):
+    room = rooms.get(room_id)
+    if room is None:
+        room_activity.pop(room_id, None)
+        return
+    commit(room_id, 'evict')
+    for token, p in room.players.items():
+        if sid_index.get(p.sid) == (room_id, token):
+            del sid_index[p.sid]
+            if p.connected: await emit('kicked', {'msg': '房間閒置過久，已關閉'}, to=p.sid)
+    await close_room(room_id)
+    await close_room(spectator_group(room_id))
+    room_limits.forget(room_id)
+    room_stats['evicted_rooms'] += 1
+    room_stats['reclaimed_players'] += len(room.players)
+    room_stats['reclaimed_messages'] += len(room.chat_history)
+
+
+async def sweep_rooms(now=None):
+    now = time.monotonic() if now is None else now
+    horizon = now - min(ROOM_IDLE_TTL, ROOM_LOBBY_TTL)
+    expired = []
+    for room_id, last in room_activity.items():
+        if last > horizon: break
+        room = rooms.get(room_id)
+        if room is None or is_expired(room, now - last): expired.append(room_id)
+    for room_id in expired:
+        try:
+            await room_actors.submit(room_id, evict_if_expired, room_id)
+        except asyncio.QueueFull:
+            pass
+        except Exception:
+            logger.exception("evicting room %s failed", room_id)
+    return len(expired)
+
+
+# 排到 actor 裡才是最後判斷，掃描之後才有人加入或操作就不回收
+async def evict_if_expired(room_id):
+    room, last = rooms.get(room_id), room_activity.get(room_id)
+    if room is None or last is None or is_expired(room, time.monotonic() - last): await evict_room(room_id)
+
+
+@applier
+def apply_evict(room_id):
+    rooms.pop(room_id, None)
+    room_activity.pop(room_id, None)
+    index_room(room_id)
+
+
+async def room_sweeper():
+    while True:
+        await asyncio.sleep(ROOM_SWEEP_INTERVAL)
+        try:
+            await sweep_rooms()
+        except Exception:
+            logger.exception("room sweep failed")
+
+
+# === 還原 ===
+# 快照只重新序列化上次快照之後有 commit 的房間，其他房間沿用快取的 JSON 字串；聊天只保存最新 CHAT_SNAPSHOT_SIZE 則
+snapshot_cache = {}
+dirty_rooms = set()
+
+
+def dump_rooms():
+    for room_id in dirty_rooms:
+        room = rooms.get(room_id)
+        if room is None:
+            snapshot_cache.pop(room_id, None)
+        else:
+            snapshot_cache[room_id] = json.dumps(room.to_dict(CHAT_SNAPSHOT_SIZE), ensure_ascii=False,
+                                                 separators=(',', ':'))
+    dirty_rooms.clear()
+    return list(snapshot_cache.values())
+
+
+def restore_rooms():
+    global replaying, event_time
+    started = time.perf_counter()
+    snapshot, records = journal.recover()
+    for d, raw in snapshot:
+        rooms[d['room_id']] = Room.from_dict(d, chat_limit=CHAT_HISTORY_LIMIT)
+        snapshot_cache[d['room_id']] = raw
+    replaying = True
+    try:
+        for record in records:
+            event_time = record['t']
+            try:
+                appliers[record['op']](record['r'], *record['a'])
+            except Exception:
+                logger.exception("replay failed at record %s", record['s'])
+    finally:
+        replaying = False
+        event_time = None
+    for room_id, room in rooms.items():
+        for token, p in room.players.items():
+            p.sid = None
+            room.set_connected(token, False)
+        touch_room(room_id)
+        index_room(room_id)
+    dirty_rooms.update(record['r'] for record in records)
+    logger.warning("restored %d rooms (%d journal records) in %.1f ms", len(rooms), len(records),
+                   (time.perf_counter() - started) * 1000)
+
+
+@app.get("/api/stats")
+async def stats():
+    return {'worker': node.id if node else 0, 'rooms': len(rooms), 'sockets': len(sid_index), **room_stats}
+
+
+# === 監控 ===
+def rooms_by_state():
+    counts = {}
+    for room in rooms.values():
+        counts[('state', room.state)] = counts.get(('state', room.state), 0) + 1
+    return counts
+
+
+metrics.gauge('avalon_rooms', '目前的房間數', lambda: len(rooms))
+metrics.gauge('avalon_rooms_by_state', '各遊戲階段的房間數', rooms_by_state)
+metrics.gauge('avalon_sockets', '已加入房間的連線數', lambda: len(sid_index))
+metrics.gauge('avalon_players_connected', '在線玩家數（含旁觀）',
+              lambda: sum(room.online_players + room.online_spectators for room in rooms.values()))
+metrics.gauge('avalon_outbox_pending', '等待合併送出的房間數', lambda: len(outbox))
+metrics.gauge('avalon_room_actors', '正在處理指令的房間數', lambda: len(room_actors.actors))
+metrics.gauge('avalon_room_queue_depth', '所有房間佇列中等待的指令數', room_actors.pending)
+metrics.gauge('avalon_lobby_rooms', '大廳目錄裡的房間數（含其他 worker 的房間）', lambda: len(lobby_index.entries))
+for key in room_stats:
+    metrics.gauge(f'avalon_{key}', f'閒置回收累計 {key}', lambda key=key: room_stats[key])
+
+
+@app.get("/metrics")
+async def metrics_endpoint():
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+
+# === 靜態資源 ===
+# 帶雜湊的網址內容永遠不變，其他路徑（首頁、舊的未加雜湊的網址）每次以 ETag 重新驗證；必須放在所有路由最後
+@app.api_route("/assets/{path:path}", methods=["GET", "HEAD"])
+async def hashed_asset(path: str, request: Request):
+    asset = site.by_url.get(assets.PREFIX + path)
+    if asset is None: raise HTTPException(404)
+    return assets.respond(request, asset, assets.IMMUTABLE)
+
+
+@app.api_route("/{path:path}", methods=["GET", "HEAD"])
+async def static_asset(path: str, request: Request):
+    asset = site.by_path.get(path or assets.ENTRY)
+    if asset is None: raise HTTPException(404)
+    return assets.respond(request, asset, assets.REVALIDATE)
 
 
 if __name__ == '__main__':
     port = int(os.environ.get("PORT", 8000))
-    uvicorn.run(app_asgi, host="0.0.0.0", port=port)
+    workers = int(os.environ.get("WORKERS", 1))
+    if workers > 1:
+        cluster.serve("server:app_asgi", "0.0.0.0", port, workers)
+    else:
+        uvicorn.run(app_asgi, host="0.0.0.0", port=port)
@@ -0,0 +1,245 @@
+# === 離線平衡模擬 ===
+# 用 engine.py 的規則快速跑大量無頭對局，統計各人數 / 角色設定下的勝率，用來離線調整房規
+#   python simulate.py --players 5-10 --games 100000
+#   python simulate.py --players 7 --settings merlin,percival,assassin,morgana,mordred --policy informed
+# RandomPolicy 在有 NumPy 時走向量化路徑，一次推進所有對局；其他策略逐局以純 Python 模擬
+import argparse
+import importlib
+import random
+import time
+from collections import Counter
+
+import engine
+from models import DEFAULT_SETTINGS
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# 結果：(勝方, 原因)
+BLUE_SURVIVED = ('BLUE', 'assassination_failed')
+RED_ASSASSINATED = ('RED', 'assassinated')
+RED_MISSIONS = ('RED', 'missions')
+RED_VOTE_TRACK = ('RED', 'vote_track')
+OUTCOMES = [BLUE_SURVIVED, RED_ASSASSINATED, RED_MISSIONS, RED_VOTE_TRACK]
+
+
+class SimGame:
+    # 策略只應讀取自己座位的 roles[seat] 與 visible[seat]，其餘欄位是公開資訊
+    __slots__ = ('count', 'roles', 'visible', 'quest_index', 'leader_index', 'vote_track', 'quest_results',
+                 'vote_log', 'rng')
+
+    def __init__(self, roles, rng):
+        self.count = len(roles)
+        self.roles = roles
+        self.visible = [set(seats) for seats in engine.visibility_table(roles, rng)]
+        self.quest_index = 0
+        self.leader_index = 0
+        self.vote_track = 0
+        self.quest_results = [None] * 5
+        self.vote_log = []
+        self.rng = rng
+
+    def is_evil(self, seat):
+        return self.roles[seat] in engine.EVIL_ROLES
+
+    def team_size(self):
+        return engine.team_size(self.count, self.quest_index)
+
+
+# === 機器人策略 ===
+# 任何實作 propose / vote / mission / assassinate 的物件都能當策略
+class RandomPolicy:
+    def __init__(self, approve=0.5, fail=1.0):
+        self.approve = approve
+        self.fail = fail
+
+    def propose(self, game, leader):
+        return game.rng.sample(range(game.count), game.team_size())
+
+    def vote(self, game, seat, team):
+        return game.rng.random() < self.approve
+
+    def mission(self, game, seat, team):
+        return not (game.is_evil(seat) and game.rng.random() < self.fail)
+
+    def assassinate(self, game, seat):
+        candidates = [i for i in range(game.count) if i != seat and i not in game.visible[seat]]
+        return game.rng.choice(candidates)
+
+
+class InformedPolicy:
+    # 梅林 / 壞人依照看得到的資訊投票；刺客刺殺最常否決「含壞人隊伍」的好人
+    def propose(self, game, leader):
+        others = [i for i in range(game.count) if i != leader]
+        if game.is_evil(leader):
+            pool = others
+        else:
+            pool = [i for i in others if i not in game.visible[leader] or game.roles[leader] == engine.PERCIVAL]
+            if len(pool) < game.team_size() - 1: pool = others
+        return [leader] + game.rng.sample(pool, game.team_size() - 1)
+
+    def vote(self, game, seat, team):
+        if game.is_evil(seat):
+            return seat in team or any(i in game.visible[seat] for i in team)
+        if game.roles[seat] == engine.MERLIN:
+            return not any(i in game.visible[seat] for i in team)
+        return game.vote_track >= engine.MAX_VOTE_TRACK - 1 or game.rng.random() < 0.6
+
+    def mission(self, game, seat, team):
+        if not game.is_evil(seat): return True
+        # 有隊友同隊時只由座位最小的那位出汙杯，避免暴露
+        mates = [i for i in team if i in game.visible[seat]]
+        return bool(mates) and min(mates) < seat
+
+    def assassinate(self, game, seat):
+        candidates = [i for i in range(game.count) if i != seat and i not in game.visible[seat]]
+        suspicion = Counter()
+        for team, votes in game.vote_log:
+            if any(game.is_evil(i) for i in team):
+                for i, v in enumerate(votes):
+                    if not v: suspicion[i] += 1
+        best = max(suspicion[i] for i in candidates)
+        return game.rng.choice([i for i in candidates if suspicion[i] == best])
+
+
+POLICIES = {'random': RandomPolicy, 'informed': InformedPolicy}
+
+
+def play_game(count, settings, policy, rng):
+    game = SimGame(engine.deal_roles(settings, count, rng), rng)
+    game.leader_index = rng.randrange(count)
+    while True:
+        team = policy.propose(game, game.leader_index)
+        votes = [policy.vote(game, seat, team) for seat in range(count)]
+        game.vote_log.append((team, votes))
+        _, _, passed = engine.tally_votes(votes)
+        game.leader_index = engine.next_leader(game.leader_index, count)
+        if not passed:
+            game.vote_track += 1
+            if game.vote_track >= engine.MAX_VOTE_TRACK: return RED_VOTE_TRACK
+            continue
+        game.vote_track = 0
+        results = [policy.mission(game, seat, team) for seat in team]
+        success, _ = engine.mission_succeeded(results, count, game.quest_index)
+        game.quest_results[game.quest_index] = success
+        game.quest_index += 1
+        outcome = engine.quest_outcome(game.quest_results)
+        if outcome == 'RED': return RED_MISSIONS
+        if outcome == 'ASSASSINATION':
+            if engine.ASSASSIN not in game.roles: return BLUE_SURVIVED
+            assassin = game.roles.index(engine.ASSASSIN)
+            target = policy.assassinate(game, assassin)
+            return RED_ASSASSINATED if engine.assassination_succeeded(game.roles[target]) else BLUE_SURVIVED
+
+
+def simulate(count, settings, policy, games, seed=None):
+    rng = random.Random(seed)
+    return Counter(play_game(count, settings, policy, rng) for _ in range(games))
+
+
+# === NumPy 向量化（僅 RandomPolicy）===
+# RandomPolicy 的組隊與投票跟座位無關，所以每一步都能對所有還沒結束的對局一起抽樣
+def simulate_vectorized(count, settings, games, seed=None, approve=0.5, fail=1.0):
+    gen = np.random.default_rng(seed)
+    deck = engine.build_deck(settings, count)
+    evil_deck = np.array([r in engine.EVIL_ROLES for r in deck])
+    evil = evil_deck[gen.permuted(np.tile(np.arange(count), (games, 1)), axis=1)]
+    sizes = np.array(engine.QUEST_CONFIG[count])
+    needed = np.array([engine.fails_required(count, q) for q in range(5)])
+
+    # 刺客在候選人（自己與看得到的隊友以外）中隨機挑一人，梅林只有一位
+    hit_chance = 0.0
+    if engine.ASSASSIN in deck and engine.MERLIN in deck:
+        seat = deck.index(engine.ASSASSIN)
+        hit_chance = 1.0 / (count - 1 - len(engine.visibility_table(deck, random.Random(0))[seat]))
+
+    quest = np.zeros(games, dtype=np.int64)
+    track = np.zeros(games, dtype=np.int64)
+    wins = np.zeros(games, dtype=np.int64)
+    losses = np.zeros(games, dtype=np.int64)
+    outcome = np.full(games, -1, dtype=np.int64)
+    live = np.arange(games)
+    while live.size:
+        n = live.size
+        passed = (gen.random((n, count)) < approve).sum(axis=1) * 2 > count
+
+        rejected = live[~passed]
+        track[rejected] += 1
+        outcome[rejected[track[rejected] >= engine.MAX_VOTE_TRACK]] = OUTCOMES.index(RED_VOTE_TRACK)
+
+        accepted = live[passed]
+        q = quest[accepted]
+        team = gen.random((accepted.size, count)).argsort(axis=1).argsort(axis=1) < sizes[q][:, None]
+        fails = (team & evil[accepted] & (gen.random((accepted.size, count)) < fail)).sum(axis=1)
+        success = fails < needed[q]
+        wins[accepted] += success
+        losses[accepted] += ~success
+        quest[accepted] += 1
+        track[accepted] = 0
+
+        red = accepted[losses[accepted] >= engine.WINS_NEEDED]
+        outcome[red] = OUTCOMES.index(RED_MISSIONS)
+        blue = accepted[wins[accepted] >= engine.WINS_NEEDED]
+        hit = gen.random(blue.size) < hit_chance
+        outcome[blue] = np.where(hit, OUTCOMES.index(RED_ASSASSINATED), OUTCOMES.index(BLUE_SURVIVED))
+
+        live = live[outcome[live] < 0]
+    counts = np.bincount(outcome, minlength=len(OUTCOMES))
+    return Counter({o: int(c) for o, c in zip(OUTCOMES, counts) if c})
+
+
+# === 命令列 ===
+def parse_players(text):
+    if '-' in text:
+        lo, hi = text.split('-')
+        return list(range(int(lo), int(hi) + 1))
+    return [int(x) for x in text.split(',')]
+
+
+def parse_settings(text):
+    if not text: return dict(DEFAULT_SETTINGS)
+    enabled = set(text.split(','))
+    unknown = enabled - {key for key, _ in engine.SPECIAL_ROLES}
+    if unknown: raise SystemExit(f"unknown roles: {', '.join(sorted(unknown))}")
+    return {key: key in enabled for key, _ in engine.SPECIAL_ROLES}
+
+
+def load_policy(name):
+    if name in POLICIES: return POLICIES[name]()
+    module_name, _, attr = name.partition(':')
+    return getattr(importlib.import_module(module_name), attr)()
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Avalon 離線平衡模擬')
+    parser.add_argument('--players', default='5-10', help='人數，例如 5-10 或 5,7,9')
+    parser.add_argument('--games', type=int, default=100000)
+    parser.add_argument('--settings', default='', help='啟用的特殊角色，逗號分隔，預設為房間預設設定')
+    parser.add_argument('--policy', default='random', help="random / informed 或 module:Class")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--no-numpy', action='store_true', help='強制使用純 Python 逐局模擬')
+    args = parser.parse_args()
+
+    settings = parse_settings(args.settings)
+    policy = load_policy(args.policy)
+    vectorized = np is not None and not args.no_numpy and type(policy) is RandomPolicy
+    print(f"policy={args.policy} games={args.games} {'numpy' if vectorized else 'python'}")
+    print(f"{'players':>7}  {'blue%':>6}  {'assassinated%':>13}  {'missions%':>9}  {'vote_track%':>11}  "
+          f"{'games/s':>10}  setup")
+    for count in parse_players(args.players):
+        started = time.perf_counter()
+        if vectorized:
+            result = simulate_vectorized(count, settings, args.games, args.seed, policy.approve, policy.fail)
+        else:
+            result = simulate(count, settings, policy, args.games, args.seed)
+        elapsed = time.perf_counter() - started
+        pct = {o: 100.0 * result[o] / args.games for o in OUTCOMES}
+        setup = ' '.join(f"{role}x{n}" for role, n in Counter(engine.build_deck(settings, count)).items())
+        print(f"{count:>7}  {pct[BLUE_SURVIVED]:>6.2f}  {pct[RED_ASSASSINATED]:>13.2f}  {pct[RED_MISSIONS]:>9.2f}  "
+              f"{pct[RED_VOTE_TRACK]:>11.2f}  {args.games / elapsed:>10.0f}  {setup}")
+
+
+if __name__ == '__main__':
+    main()
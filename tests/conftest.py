@@ -0,0 +1,5 @@
+# 伺服器是平鋪在專案根目錄的模組，測試直接 import server / lobby / models
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,100 @@
+# 房間 actor：同一房間的指令依序執行完（包含中間的 await）才換下一個，佇列滿了就拒收
+import asyncio
+
+import pytest
+
+import server
+from actors import Registry
+
+
+def test_commands_run_in_order_per_room():
+    log = []
+
+    async def command(key, i):
+        log.append((key, i, 'start'))
+        await asyncio.sleep(0.001 * (3 - i % 3))
+        log.append((key, i, 'end'))
+        return i
+
+    async def run():
+        registry = Registry(100)
+        futures = [registry.submit(key, command, key, i) for i in range(6) for key in ('a', 'b')]
+        assert await asyncio.gather(*futures) == [i for i in range(6) for _ in 'ab']
+        return registry
+
+    registry = asyncio.run(run())
+    for key in 'ab':
+        # 同一房間：每個指令開始到結束之間沒有別的指令插進來
+        assert [(i, step) for k, i, step in log if k == key] == [(i, step) for i in range(6) for step in ('start', 'end')]
+    # 不同房間互不等待，兩邊交錯進行
+    assert [k for k, _, _ in log[:4]] != ['a'] * 4
+    # 佇列清空後 actor 就移除
+    assert registry.actors == {}
+
+
+def test_queue_full_and_force():
+    async def run():
+        registry = Registry(2)
+        gate = asyncio.Event()
+        done = []
+
+        async def command(i):
+            await gate.wait()
+            done.append(i)
+
+        first = registry.submit('a', command, 0)
+        await asyncio.sleep(0)
+        # 第一個已經在執行，佇列裡還能再放 2 個
+        queued = [registry.submit('a', command, i) for i in (1, 2)]
+        with pytest.raises(asyncio.QueueFull):
+            registry.submit('a', command, 3)
+        assert registry.pending() == 2
+        # 別的房間不受影響；force 的指令無視上限
+        other = registry.submit('b', command, 10)
+        forced = registry.submit('a', command, 4, force=True)
+        gate.set()
+        await asyncio.gather(first, *queued, other, forced)
+        assert [i for i in done if i < 10] == [0, 1, 2, 4]
+        assert registry.actors == {}
+
+    asyncio.run(run())
+
+
+def test_failed_command_does_not_stop_the_actor():
+    async def fail():
+        raise ValueError('boom')
+
+    async def ok():
+        return 'ok'
+
+    async def run():
+        registry = Registry(10)
+        bad, good = registry.submit('a', fail), registry.submit('a', ok)
+        with pytest.raises(ValueError):
+            await bad
+        assert await good == 'ok'
+
+    asyncio.run(run())
+
+
+# 伺服器這邊：房間佇列滿了回覆 busy，斷線照樣排進去
+def test_full_room_replies_busy(monkeypatch):
+    sent, handled = [], []
+
+    async def emit(event, data, room=None, to=None):
+        sent.append((event, to))
+
+    async def handler(sid, *args):
+        handled.append(sid)
+
+    monkeypatch.setattr(server, 'room_actors', Registry(0))
+    monkeypatch.setattr(server, 'emit', emit)
+    monkeypatch.setattr(server, 'sid_index', {'s1': ('r1', 't1')})
+
+    async def run():
+        await server.in_room('vote_team', handler)('s1', {'vote': True})
+        await server.in_room('disconnect', handler)('s1')
+
+    asyncio.run(run())
+    assert sent == [('busy', 's1')]
+    assert handled == ['s1']
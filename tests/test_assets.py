@@ -0,0 +1,38 @@
+# 依 Accept-Encoding / Accept 挑版本：q=0 是明確拒絕，不能只看字串裡有沒有出現
+import io
+
+import pytest
+
+import assets
+from assets import Asset, qvalues
+
+TEXT = b'console.log("avalon");\n' * 200
+
+
+def test_qvalues():
+    assert qvalues('gzip, deflate, br') == {'gzip': 1.0, 'deflate': 1.0, 'br': 1.0}
+    assert qvalues('gzip;q=0.5, BR ; q=0, *;q=0') == {'gzip': 0.5, 'br': 0.0, '*': 0.0}
+    assert qvalues('gzip;q=abc') == {'gzip': 0.0}
+    assert qvalues('') == {}
+
+
+def test_encoding_respects_q_zero():
+    asset = Asset('app.js', TEXT)
+    best = 'br' if assets.brotli else 'gzip'
+    assert asset.select('gzip, deflate, br', '').encoding == best
+    assert asset.select('gzip;q=0', '').encoding is None
+    assert asset.select('gzip;q=0, br;q=0', '').encoding is None
+    assert asset.select('br;q=0, gzip;q=0.8', '').encoding == 'gzip'
+    assert asset.select('*', '').encoding == best
+    assert asset.select('*;q=0', '').encoding is None
+    assert asset.select('', '').encoding is None
+
+
+@pytest.mark.skipif(assets.Image is None, reason='需要 Pillow')
+def test_webp_respects_q_zero():
+    out = io.BytesIO()
+    assets.Image.new('RGB', (64, 64), (200, 30, 30)).save(out, 'PNG', compress_level=0)
+    asset = Asset('img/red.png', out.getvalue())
+    assert asset.select('', 'image/avif,image/webp,*/*').media_type == 'image/webp'
+    assert asset.select('', 'image/webp;q=0, */*').media_type == 'image/png'
+    assert asset.select('', '*/*').media_type == 'image/png'
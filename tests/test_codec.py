@@ -0,0 +1,149 @@
+# 精簡傳輸格式：encode 的結果照 index.html 的 expandWire 還原後要跟原本的 JSON 一樣，兩邊的欄位表也要一致
+import json
+import os
+import re
+import uuid
+from collections import OrderedDict
+
+import pytest
+
+import codec
+import lobby
+import server
+
+msgpack = pytest.importorskip('msgpack')
+
+INDEX_HTML = os.path.join(os.path.dirname(server.__file__), 'static', 'index.html')
+
+
+# === index.html 的 expandWire，照抄成 Python ===
+def wire_token(t):
+    return str(uuid.UUID(bytes=t)) if isinstance(t, bytes) else t
+
+
+def from_row(fields, row):
+    return dict(zip(fields, row))
+
+
+def expand_state(data):
+    keys = {short: key for key, short in codec.KEYS.items()}
+    out = {}
+    for k, v in data.items():
+        key = keys.get(k, k)
+        if key == 'players':
+            v = [{**from_row(codec.PLAYER_FIELDS, row), 'token': wire_token(row[0])} for row in v]
+        elif key == 'player_patch':
+            v = {wire_token(t): {codec.PLAYER_FIELDS[i]: x for i, x in f.items()} for t, f in v}
+        elif key == 'game_history':
+            v = [from_row(codec.HISTORY_FIELDS, row) for row in v]
+        elif key == 'chat_history':
+            v = [from_row(codec.MESSAGE_FIELDS, row) for row in v]
+        elif key == 'host_token':
+            v = wire_token(v)
+        elif key == 'revealed_roles':
+            v = {wire_token(t): r for t, r in v}
+        elif key in ('set', 'append'):
+            v = expand_state(v)
+        out[key] = v
+    return out
+
+
+DECODERS = {
+    'update_state': expand_state, 'state_patch': expand_state,
+    'new_message': lambda row: from_row(codec.MESSAGE_FIELDS, row),
+    'history_page': lambda d: {'messages': [from_row(codec.MESSAGE_FIELDS, r) for r in d['messages']],
+                               'has_more': d['has_more']},
+    'join_success': lambda d: {**d, 'token': wire_token(d['token'])},
+}
+
+
+def decode(event, body):
+    raw = msgpack.unpackb(body, raw=False, strict_map_key=False)
+    expand = lambda ev, d: DECODERS[ev](d) if ev in DECODERS else d
+    return [[ev, expand(ev, d)] for ev, d in raw] if event == 'batch' else expand(event, raw)
+
+
+def round_trip(event, data):
+    assert decode(event, codec.encode(event, data)) == json.loads(json.dumps(data))
+
+
+# === 用真的房間產生狀態 ===
+@pytest.fixture
+def game(monkeypatch):
+    monkeypatch.setattr(server, 'journal', None)
+    monkeypatch.setattr(server, 'rooms', {})
+    monkeypatch.setattr(server, 'room_activity', OrderedDict())
+    monkeypatch.setattr(server, 'lobby_index', lobby.Directory(server.lobby_index.max_seats))
+    monkeypatch.setattr(server, 'outbox', {})
+    monkeypatch.setattr(server, 'spectator_outbox', {})
+    monkeypatch.setattr(server, 'queue_emit', lambda *args: None)
+    tokens = [str(uuid.UUID(int=i + 1)) for i in range(6)]
+    states = []
+
+    def step(op, *args):
+        server.commit('r1', op, *args)
+        states.append(server.build_state(server.rooms['r1']))
+
+    for i, t in enumerate(tokens[:5]): step('join', t, f'p{i}', 'a.png')
+    step('start', 42)
+    step('join', tokens[5], 'watcher', 'b.png')
+    for quest in range(3):
+        room = server.rooms['r1']
+        team = room.seats[:states[-1]['team_size_needed']]
+        step('select_team', team)
+        for t in room.seats: step('vote_team', t, True)
+        for t in team: step('vote_mission', t, True)
+    step('chat', tokens[0], '你好')
+    step('assassinate', tokens[1])
+    return states
+
+
+def test_schema_covers_every_state_field(game):
+    final = game[-1]
+    assert final['state'] == 'GAME_OVER' and final['revealed_roles'] and final['game_history']
+    for data in game:
+        assert set(data) <= set(codec.KEYS)
+        for p in data['players']: assert tuple(p) == codec.PLAYER_FIELDS
+        for h in data['game_history']: assert set(h) == set(codec.HISTORY_FIELDS)
+    for m in server.rooms['r1'].chat_history: assert tuple(m) == codec.MESSAGE_FIELDS
+
+
+def test_states_and_patches_round_trip(game):
+    prev = None
+    for data in game:
+        snapshot = dict(data, v=7)
+        snapshot['chat_history'], snapshot['chat_has_more'] = server.chat_page(server.rooms['r1'])
+        round_trip('update_state', snapshot)
+        patch = server.state_patch(prev, data)
+        patch['v'] = 8
+        round_trip('state_patch', patch)
+        prev = server.remember_state(dict(data))
+
+
+def test_other_events_round_trip(game):
+    messages, has_more = server.chat_page(server.rooms['r1'], limit=3)
+    round_trip('new_message', messages[-1])
+    round_trip('history_page', {'messages': messages, 'has_more': has_more})
+    round_trip('join_success', {'token': str(uuid.UUID(int=9)), 'is_spectator': False})
+    round_trip('role_info', {'role': '梅林', 'teammates': ['p1']})
+    round_trip('batch', [['new_message', messages[0]], ['vote_finished', {'details': 'x', 'pass': True}],
+                         ['state_patch', {'set': {'vote_track': 1}, 'v': 3}]])
+    # 不是 UUID 的 token 原樣送出
+    round_trip('join_success', {'token': 'not-a-uuid', 'is_spectator': True})
+
+
+# index.html 手寫了一份同樣的表，改 codec.py 時漏改前端會在這裡被抓到
+def test_client_tables_match():
+    with open(INDEX_HTML, encoding='utf-8') as f:
+        html = f.read()
+
+    def js_value(name):
+        body = re.search(r'const %s = (\[.*?\]|\{.*?\}|\'.*?\');' % name, html, re.S).group(1)
+        body = re.sub(r'(\w+):', r'"\1":', body) if body.startswith('{') else body
+        return json.loads(body.replace("'", '"'))
+
+    assert js_value('WIRE_CODEC') == codec.NAME
+    assert js_value('WIRE_KEYS') == {short: key for key, short in codec.KEYS.items()}
+    assert tuple(js_value('PLAYER_FIELDS')) == codec.PLAYER_FIELDS
+    assert tuple(js_value('HISTORY_FIELDS')) == codec.HISTORY_FIELDS
+    assert tuple(js_value('MESSAGE_FIELDS')) == codec.MESSAGE_FIELDS
@@ -0,0 +1,98 @@
+# lobby.Directory：查詢與分頁的結果要跟逐一掃過所有房間一樣
+import random
+
+from lobby import Directory
+from models import GameState
+
+MAX_SEATS = 10
+STATES = [GameState.LOBBY, GameState.TEAM_SELECTION, GameState.MISSION, GameState.GAME_OVER]
+
+
+def brute_force(rooms, states=None, min_players=0, max_players=None, min_open_seats=0):
+    directory = Directory(MAX_SEATS)
+    return sorted(room_id for room_id, (state, players, spectators) in rooms.items()
+                  if (not states or state in states) and players >= min_players
+                  and (max_players is None or players <= max_players)
+                  and directory.open_seats(state, players) >= min_open_seats)
+
+
+def all_pages(directory, limit, **filters):
+    pages, after = [], None
+    while True:
+        page = directory.query(after=after, limit=limit, **filters)
+        pages.append(page)
+        if page['next'] is None: return pages
+        after = page['next']
+
+
+def random_filters(rng):
+    return {'states': rng.choice([None, [GameState.LOBBY], [GameState.LOBBY, GameState.MISSION]]),
+            'min_players': rng.randrange(4), 'max_players': rng.choice([None, 5, 8]),
+            'min_open_seats': rng.choice([0, 1, 3])}
+
+
+def test_update_reports_changes():
+    directory = Directory(MAX_SEATS)
+    assert directory.update('a', GameState.LOBBY, 3, 0)
+    assert not directory.update('a', GameState.LOBBY, 3, 0)
+    assert directory.update('a', GameState.LOBBY, 3, 1)
+    assert directory.summary('a') == {'room_id': 'a', 'state': GameState.LOBBY, 'players': 3, 'spectators': 1,
+                                      'open_seats': 7}
+    assert directory.remove('a')
+    assert not directory.remove('a')
+    assert directory.buckets == {}
+
+
+def test_started_rooms_have_no_open_seats():
+    directory = Directory(MAX_SEATS)
+    directory.update('a', GameState.MISSION, 5, 0)
+    directory.update('b', GameState.LOBBY, 10, 0)
+    directory.update('c', GameState.LOBBY, 4, 2)
+    assert [r['room_id'] for r in directory.query(min_open_seats=1)['rooms']] == ['c']
+
+
+def test_queries_match_brute_force():
+    rng = random.Random(3)
+    directory = Directory(MAX_SEATS)
+    rooms = {}
+    for step in range(2000):
+        room_id = f'room{rng.randrange(300):03d}'
+        if rng.random() < 0.15:
+            assert directory.remove(room_id) == (rooms.pop(room_id, None) is not None)
+        else:
+            rooms[room_id] = (rng.choice(STATES), rng.randrange(1, MAX_SEATS + 1), rng.randrange(3))
+            directory.update(room_id, *rooms[room_id])
+        if step % 100 == 0:
+            filters = random_filters(rng)
+            expected = brute_force(rooms, **filters)
+            pages = all_pages(directory, rng.randrange(1, 30), **filters)
+            assert [r['room_id'] for page in pages for r in page['rooms']] == expected
+            assert all(page['total'] == len(expected) for page in pages)
+            assert all(r == directory.summary(r['room_id']) for page in pages for r in page['rooms'])
+
+
+def test_paging_survives_changes_between_pages():
+    rng = random.Random(5)
+    directory = Directory(MAX_SEATS)
+    rooms = {}
+    for i in range(200):
+        rooms[f'room{i:03d}'] = (GameState.LOBBY, rng.randrange(1, 6), 0)
+        directory.update(f'room{i:03d}', *rooms[f'room{i:03d}'])
+    seen, after = [], None
+    while True:
+        page = directory.query(states=[GameState.LOBBY], after=after, limit=15)
+        seen += [r['room_id'] for r in page['rooms']]
+        if page['next'] is None: break
+        after = page['next']
+        # 翻頁途中有房間開局、新增或解散：還沒翻到的照新狀態，已翻過的不會重複
+        for _ in range(5):
+            room_id = f'room{rng.randrange(260):03d}'
+            if rng.random() < 0.5:
+                directory.remove(room_id)
+                rooms.pop(room_id, None)
+            else:
+                rooms[room_id] = (rng.choice(STATES), rng.randrange(1, 6), 0)
+                directory.update(room_id, *rooms[room_id])
+    assert seen == sorted(set(seen))
+    assert [r for r in seen if r > after] == brute_force(
+        {k: v for k, v in rooms.items() if k > after}, states=[GameState.LOBBY])
@@ -0,0 +1,85 @@
+# journal 的當機還原：寫到一半的最後一筆要丟掉，之後接著寫的紀錄不能被它拖累
+import asyncio
+import os
+
+from persistence import Journal, SNAPSHOT_FILE, segment_name
+
+
+def write(directory, records, snapshot=None):
+    async def run():
+        journal = Journal(str(directory))
+        journal.recover()
+        for room, op, args in records: journal.append(room, op, args, 1.0)
+        await journal.flush()
+        if snapshot is not None: await journal.snapshot(lambda: snapshot)
+        journal.executor.shutdown()
+    asyncio.run(run())
+
+
+def recover(directory):
+    journal = Journal(str(directory))
+    snapshot, records = journal.recover()
+    journal.executor.shutdown()
+    return journal, snapshot, [(r['s'], r['op'], r['a']) for r in records]
+
+
+def tear(directory, keep):
+    path = os.path.join(directory, sorted(n for n in os.listdir(directory) if n.startswith('wal-'))[-1])
+    with open(path, 'rb') as f:
+        body = f.read()
+    with open(path, 'wb') as f:
+        f.write(body[:len(body) - keep])
+
+
+def test_recover_replays_in_order(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', f'm{i}']) for i in range(3)])
+    write(tmp_path, [('r1', 'chat', ['t', 'm3'])])
+    journal, snapshot, records = recover(tmp_path)
+    assert snapshot == []
+    assert records == [(i + 1, 'chat', ['t', f'm{i}']) for i in range(4)]
+    assert journal.seq == 4
+
+
+def test_torn_last_record_is_dropped(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', f'm{i}']) for i in range(3)])
+    tear(tmp_path, 5)
+    journal, _, records = recover(tmp_path)
+    assert [s for s, _, _ in records] == [1, 2]
+    assert journal.seq == 2
+
+
+def test_records_after_a_torn_tail_survive(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', f'm{i}']) for i in range(3)])
+    tear(tmp_path, 5)
+    write(tmp_path, [('r1', 'chat', ['t', 'after'])])
+    _, _, records = recover(tmp_path)
+    assert records == [(1, 'chat', ['t', 'm0']), (2, 'chat', ['t', 'm1']), (3, 'chat', ['t', 'after'])]
+
+
+# 快照之後的第一筆就寫壞時，重啟後接著寫的 segment 檔名會跟壞掉的那個相同
+def test_torn_first_record_after_snapshot(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', 'm0'])], snapshot=['{"room_id":"r1"}'])
+    write(tmp_path, [('r1', 'chat', ['t', 'm1'])])
+    assert os.listdir(tmp_path).count(segment_name(2)) == 1
+    tear(tmp_path, 5)
+    write(tmp_path, [('r1', 'chat', ['t', 'after']), ('r1', 'chat', ['t', 'after2'])])
+    journal, snapshot, records = recover(tmp_path)
+    assert snapshot == [({'room_id': 'r1'}, '{"room_id":"r1"}')]
+    assert records == [(2, 'chat', ['t', 'after']), (3, 'chat', ['t', 'after2'])]
+
+
+# 整行 JSON 寫完、只差換行時紀錄本身是完整的，照常保留
+def test_record_without_newline_is_kept(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', 'm0']), ('r1', 'chat', ['t', 'm1'])])
+    tear(tmp_path, 1)
+    write(tmp_path, [('r1', 'chat', ['t', 'after'])])
+    _, _, records = recover(tmp_path)
+    assert records == [(1, 'chat', ['t', 'm0']), (2, 'chat', ['t', 'm1']), (3, 'chat', ['t', 'after'])]
+
+
+def test_snapshot_drops_covered_segments(tmp_path):
+    write(tmp_path, [('r1', 'chat', ['t', 'm0'])])
+    write(tmp_path, [('r1', 'chat', ['t', 'm1'])], snapshot=['{"room_id":"r1"}'])
+    assert sorted(os.listdir(tmp_path)) == [SNAPSHOT_FILE]
+    journal, snapshot, records = recover(tmp_path)
+    assert (journal.seq, len(snapshot), records) == (2, 1, [])
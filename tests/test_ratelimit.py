@@ -0,0 +1,144 @@
+# token bucket 與聊天洪水的合併送出
+import asyncio
+
+import pytest
+
+import ratelimit
+import server
+from ratelimit import Limiter, TokenBucket, parse_budgets
+
+
+class Clock:
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(ratelimit.time, 'monotonic', clock)
+    return clock
+
+
+def test_bucket_burst_then_refill():
+    bucket = TokenBucket(2, 3, now=0)
+    assert [bucket.take(0) for _ in range(4)] == [True, True, True, False]
+    assert bucket.wait(0) == pytest.approx(0.5)
+    assert not bucket.take(0.4)
+    assert bucket.take(0.5)
+    # 補充不會超過 burst
+    assert [bucket.take(100) for _ in range(4)] == [True, True, True, False]
+
+
+def test_limiter_budgets_per_key_and_event(clock):
+    limiter = Limiter({'*': (10, 2), 'send_chat': (1, 1)})
+    assert limiter.take('s1', 'send_chat')
+    assert not limiter.take('s1', 'send_chat')
+    # 別的連線、別的事件各有自己的 bucket
+    assert limiter.take('s2', 'send_chat')
+    assert limiter.take('s1', 'vote_team') and limiter.take('s1', 'vote_team')
+    assert not limiter.take('s1', 'vote_team')
+    assert limiter.wait('s1', 'send_chat') == pytest.approx(1)
+    clock.now += 1
+    assert limiter.take('s1', 'send_chat')
+
+
+def test_refund_and_forget(clock):
+    limiter = Limiter({'*': (1, 2)})
+    assert limiter.take('s1', 'x') and limiter.take('s1', 'x')
+    limiter.refund('s1', 'x')
+    assert limiter.take('s1', 'x')
+    assert not limiter.take('s1', 'x')
+    limiter.refund('s1', 'x')
+    limiter.refund('s1', 'x')
+    limiter.refund('s1', 'x')
+    assert limiter.buckets['s1']['x'].tokens == 2
+    limiter.forget('s1')
+    assert 's1' not in limiter.buckets
+
+
+def test_parse_budgets():
+    budgets = parse_budgets(' send_chat=2/6, join_room=1 ,,', {'*': (10, 20), 'send_chat': (5, 5)})
+    assert budgets == {'*': (10, 20), 'send_chat': (2, 6), 'join_room': (1, 1)}
+
+
+# === 聊天合併 ===
+class ScriptedLimiter:
+    def __init__(self, answers):
+        self.answers = list(answers)
+        self.taken = self.refunded = 0
+
+    def wait(self, key, event):
+        return 0
+
+    def take(self, key, event):
+        ok = self.answers.pop(0) if self.answers else True
+        self.taken += ok
+        return ok
+
+    def refund(self, key, event):
+        self.refunded += 1
+
+
+@pytest.fixture
+def chat(monkeypatch):
+    monkeypatch.setattr(server, 'sid_index', {'s1': ('r1', 't1')})
+    monkeypatch.setattr(server, 'chat_pending', {})
+    sent = []
+
+    async def handler(sid, data):
+        sent.append((sid, data['message']))
+    return sent, handler
+
+
+def test_flush_merges_pending_chat(chat, monkeypatch):
+    sent, handler = chat
+    monkeypatch.setattr(server, 'sid_limits', ScriptedLimiter([]))
+    monkeypatch.setattr(server, 'room_limits', ScriptedLimiter([]))
+
+    async def run():
+        for i in range(server.CHAT_MERGE_LIMIT + 3): server.defer_chat('s1', 'r1', handler, {'message': f'm{i}'})
+        await asyncio.gather(*server.flush_tasks)
+
+    asyncio.run(run())
+    assert sent == [('s1', server.CHAT_SEPARATOR.join(f'm{i}' for i in range(server.CHAT_MERGE_LIMIT)))]
+    assert server.chat_pending == {}
+
+
+def test_flush_waits_again_when_room_bucket_is_drained(chat, monkeypatch):
+    sent, handler = chat
+    sid_limits = ScriptedLimiter([True, False, True])
+    room_limits = ScriptedLimiter([False, True])
+    monkeypatch.setattr(server, 'sid_limits', sid_limits)
+    monkeypatch.setattr(server, 'room_limits', room_limits)
+
+    async def run():
+        server.defer_chat('s1', 'r1', handler, {'message': 'a'})
+        await asyncio.sleep(0)
+        server.defer_chat('s1', 'r1', handler, {'message': 'b'})
+        await asyncio.gather(*server.flush_tasks)
+
+    asyncio.run(run())
+    # 第一輪拿到連線的 token 但房間的沒拿到，要退回；第二輪連線沒 token；第三輪兩個都拿到才送
+    assert sent == [('s1', 'a' + server.CHAT_SEPARATOR + 'b')]
+    assert sid_limits.refunded == 1
+    assert (sid_limits.taken, room_limits.taken) == (2, 1)
+
+
+def test_flush_drops_chat_after_leaving_the_room(chat, monkeypatch):
+    sent, handler = chat
+    monkeypatch.setattr(server, 'sid_limits', ScriptedLimiter([False]))
+    monkeypatch.setattr(server, 'room_limits', ScriptedLimiter([]))
+
+    async def run():
+        server.defer_chat('s1', 'r1', handler, {'message': 'a'})
+        await asyncio.sleep(0)
+        server.sid_index['s1'] = ('r2', 't1')
+        await asyncio.gather(*server.flush_tasks)
+
+    asyncio.run(run())
+    assert sent == []
+    assert server.chat_pending == {}
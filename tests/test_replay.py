@@ -0,0 +1,195 @@
+# 重播的確定性：同一串 commit 寫進 journal 後重啟還原，房間內容要跟當下一模一樣
+import asyncio
+from collections import OrderedDict
+
+import pytest
+
+import lobby
+import persistence
+import server
+from models import GameState
+
+ROOM = 'r1'
+TOKENS = [f't{i}' for i in range(7)]
+
+
+@pytest.fixture
+def fresh(monkeypatch, tmp_path):
+    monkeypatch.setattr(server, 'rooms', {})
+    monkeypatch.setattr(server, 'room_activity', OrderedDict())
+    monkeypatch.setattr(server, 'lobby_index', lobby.Directory(server.lobby_index.max_seats))
+    monkeypatch.setattr(server, 'outbox', {})
+    monkeypatch.setattr(server, 'spectator_outbox', {})
+    monkeypatch.setattr(server, 'snapshot_cache', {})
+    monkeypatch.setattr(server, 'dirty_rooms', set())
+    return tmp_path
+
+
+# 模擬重啟：清空記憶體裡的房間，用新的 Journal 從同一個目錄還原
+def restart(directory, monkeypatch):
+    server.journal.executor.shutdown()
+    server.rooms.clear()
+    server.snapshot_cache.clear()
+    server.dirty_rooms.clear()
+    monkeypatch.setattr(server, 'journal', persistence.Journal(str(directory)))
+    server.restore_rooms()
+
+
+def chat(n, tag):
+    for i in range(n): server.commit(ROOM, 'chat', TOKENS[i % 5], f'{tag} {i}')
+
+
+def play_round(approve, fails):
+    room = server.rooms[ROOM]
+    size = server.build_state(room)['team_size_needed']
+    team = room.seats[:size]
+    server.commit(ROOM, 'select_team', team)
+    for token in room.seats: server.commit(ROOM, 'vote_team', token, approve)
+    if not approve: return
+    for i, token in enumerate(team): server.commit(ROOM, 'vote_mission', token, i >= fails)
+
+
+def play_game():
+    for token in TOKENS[:6]: server.commit(ROOM, 'join', token, f'p{token}', 'a.png')
+    server.commit(ROOM, 'kick', TOKENS[5])
+    server.commit(ROOM, 'settings', {**server.rooms[ROOM].settings, 'oberon': True})
+    server.commit(ROOM, 'first_leader', TOKENS[2])
+    for token in TOKENS[:5]: server.commit(ROOM, 'ready', token)
+    server.commit(ROOM, 'start', 1234567)
+    server.commit(ROOM, 'join', TOKENS[6], 'watcher', 'b.png')
+    chat(30, 'before')
+    play_round(False, 0)
+    play_round(True, 1)
+    chat(40, 'middle')
+    play_round(True, 0)
+
+
+def finish_game():
+    play_round(True, 0)
+    play_round(True, 0)
+    chat(5, 'after')
+    server.commit(ROOM, 'assassinate', TOKENS[0])
+
+
+async def settle():
+    await asyncio.gather(*server.flush_tasks)
+    await server.journal.flush()
+
+
+def snapshot_rooms():
+    return {room_id: room.to_dict() for room_id, room in server.rooms.items()}
+
+
+def test_replay_restores_identical_rooms(fresh, monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, 'journal', persistence.Journal(str(fresh)))
+        server.restore_rooms()
+        play_game()
+        finish_game()
+        await settle()
+        before = snapshot_rooms()
+        assert server.rooms[ROOM].state == GameState.GAME_OVER
+        restart(fresh, monkeypatch)
+        assert snapshot_rooms() == before
+        server.journal.executor.shutdown()
+
+    asyncio.run(run())
+
+
+def test_snapshot_then_replay_restores_identical_rooms(fresh, monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, 'journal', persistence.Journal(str(fresh)))
+        server.restore_rooms()
+        play_game()
+        await settle()
+        await server.journal.snapshot(server.dump_rooms)
+        first_kept = server.rooms[ROOM].chat_history[-server.CHAT_SNAPSHOT_SIZE]['id']
+        finish_game()
+        await settle()
+        before = snapshot_rooms()
+        restart(fresh, monkeypatch)
+        after = snapshot_rooms()
+        # 快照只保存當時最新的 CHAT_SNAPSHOT_SIZE 則聊天，之後的由重播補上
+        assert after[ROOM]['chat_history'] == [m for m in before[ROOM]['chat_history'] if m['id'] >= first_kept]
+        for d in (before[ROOM], after[ROOM]): del d['chat_history']
+        assert after == before
+        server.journal.executor.shutdown()
+
+    asyncio.run(run())
+
+
+# 還原後玩家都還沒重連、沒有 sid；這時開局只能把身分送給已重連的人，不能變成對所有連線廣播
+def test_start_after_restore_sends_roles_only_to_connected(fresh, monkeypatch):
+    sent = []
+
+    async def fake_emit(event, data, to=None, room=None):
+        sent.append((event, data, to, room))
+
+    async def run():
+        monkeypatch.setattr(server, 'journal', persistence.Journal(str(fresh)))
+        server.restore_rooms()
+        for token in TOKENS[:5]: server.commit(ROOM, 'join', token, f'p{token}', 'a.png')
+        await settle()
+        restart(fresh, monkeypatch)
+        monkeypatch.setattr(server.sio, 'emit', fake_emit)
+        room = server.rooms[ROOM]
+        room.players[TOKENS[1]].sid = 'sid1'
+        room.set_connected(TOKENS[1], True)
+        await server.start_game_logic(ROOM)
+        await settle()
+        assert room.state == GameState.TEAM_SELECTION
+        roles = [(data, to) for event, data, to, _ in sent if event == 'role_info']
+        assert [to for _, to in roles] == ['sid1']
+        assert roles[0][0]['role'] == room.players[TOKENS[1]].role
+        assert all(to is not None or group is not None for _, _, to, group in sent)
+        # 沒有對象的 emit 直接擋下
+        sent.clear()
+        await server.emit('role_info', {'role': 'x'})
+        assert sent == []
+        server.journal.executor.shutdown()
+
+    asyncio.run(run())
+
+
+# 不合法的隊伍與刺殺在寫進 journal 之前就要擋掉，不能留下重播時會失敗的紀錄
+def test_invalid_team_and_assassination_are_not_journaled(fresh, monkeypatch):
+    async def run():
+        monkeypatch.setattr(server, 'journal', persistence.Journal(str(fresh)))
+        monkeypatch.setattr(server, 'sid_index', {})
+        server.restore_rooms()
+        for token in TOKENS[:6]: server.commit(ROOM, 'join', token, f'p{token}', 'a.png')
+        server.commit(ROOM, 'start', 1234567)
+        server.commit(ROOM, 'join', TOKENS[6], 'watcher', 'b.png')
+        for token in TOKENS[:7]: server.sid_index[f'sid-{token}'] = (ROOM, token)
+        room = server.rooms[ROOM]
+        leader = room.leader_token
+        other = next(t for t in room.seats if t != leader)
+        size = server.build_state(room)['team_size_needed']
+        seq = server.journal.seq
+
+        async def send(token, event, data):
+            await server.handlers[event](f'sid-{token}', data)
+
+        for team in (['nope'] * size, room.seats[:size - 1], [leader] * size, [TOKENS[6]] + room.seats[:size - 1],
+                     'abc', [[leader]] + room.seats[:size - 1]):
+            await send(leader, 'select_team', {'team': team})
+        await send(other, 'select_team', {'team': room.seats[:size]})
+        await send(leader, 'assassinate', {'target_token': other})
+        assert server.journal.seq == seq and room.state == GameState.TEAM_SELECTION
+
+        await send(leader, 'select_team', {'team': room.seats[:size]})
+        assert server.journal.seq == seq + 1 and room.state == GameState.TEAM_VOTING
+
+        room.state = GameState.ASSASSINATION
+        assassin = next(t for t in room.seats if room.players[t].role == '刺客')
+        target = next(t for t in room.seats if t != assassin)
+        await send(target, 'assassinate', {'target_token': assassin})
+        for bad in ('nope', assassin, TOKENS[6], ['x']):
+            await send(assassin, 'assassinate', {'target_token': bad})
+        assert server.journal.seq == seq + 1 and room.state == GameState.ASSASSINATION
+        await send(assassin, 'assassinate', {'target_token': target})
+        assert server.journal.seq == seq + 2 and room.state == GameState.GAME_OVER
+        await settle()
+        server.journal.executor.shutdown()
+
+    asyncio.run(run())
@@ -0,0 +1,96 @@
+# diff_state：算出的差異套用到上一份狀態上（跟前端 state_patch 的做法一樣）要得到新的狀態
+import copy
+import random
+
+from server import diff_state, remember_state, state_patch
+
+
+def make_state(players=3, history=None):
+    return {
+        'state': 'LOBBY', 'quest_results': [None] * 5, 'quest_idx': 0, 'vote_track': 0,
+        'host_token': 't0', 'settings': {'merlin': True},
+        'players': [{'token': f't{i}', 'name': f'p{i}', 'is_ready': False, 'in_team': False}
+                    for i in range(players)],
+        'game_history': [] if history is None else history,
+    }
+
+
+# 前端的套用方式
+def apply(prev, patch):
+    state = copy.deepcopy({k: v for k, v in prev.items() if k != 'game_history_ref'})
+    if 'players' in patch: state['players'] = copy.deepcopy(patch['players'])
+    for p in state['players']: p.update(patch.get('player_patch', {}).get(p['token'], {}))
+    if 'append' in patch: state['game_history'] = state['game_history'] + patch['append']['game_history']
+    state.update(copy.deepcopy(patch.get('set', {})))
+    return state
+
+
+def test_no_change_gives_empty_patch():
+    history = [{'quest': 1}]
+    assert diff_state(remember_state(make_state(history=history)), make_state(history=history)) == {}
+
+
+def test_first_patch_is_full_state():
+    data = make_state()
+    patch = state_patch(None, data)
+    assert apply({'players': [], 'game_history': []}, patch) == data
+
+
+def test_changed_fields_only():
+    history = []
+    prev = remember_state(make_state(history=history))
+    data = make_state(history=history)
+    data['state'] = 'TEAM_SELECTION'
+    data['players'][1]['is_ready'] = True
+    patch = diff_state(prev, data)
+    assert patch['set'] == {'state': 'TEAM_SELECTION'}
+    assert patch['player_patch'] == {'t1': {'is_ready': True}}
+    assert 'players' not in patch
+
+
+def test_player_list_change_sends_whole_list():
+    history = []
+    prev = remember_state(make_state(players=3, history=history))
+    data = make_state(players=4, history=history)
+    patch = diff_state(prev, data)
+    assert patch['players'] == data['players']
+    assert 'player_patch' not in patch
+
+
+def test_history_append_and_replace():
+    history = [{'quest': 1}]
+    prev = remember_state(make_state(history=history))
+    history.append({'quest': 2})
+    assert diff_state(prev, make_state(history=history)) == {'append': {'game_history': [{'quest': 2}]}}
+    # 換局時 game_history 換成新的 list，要整份重送
+    patch = diff_state(prev, make_state(history=[]))
+    assert patch == {'set': {'game_history': []}}
+
+
+def test_random_changes_round_trip():
+    rng = random.Random(7)
+    tokens = iter(range(100, 10000))
+    history = []
+    prev = make_state(history=history)
+    client = apply(prev, {})
+    synced = remember_state(prev)
+    for _ in range(500):
+        data = copy.deepcopy({k: v for k, v in synced.items() if k not in ('game_history_ref', 'game_history')})
+        data['game_history'] = history
+        roll = rng.random()
+        if roll < 0.2:
+            data['vote_track'] = rng.randrange(5)
+        elif roll < 0.5:
+            rng.choice(data['players'])['is_ready'] = rng.random() < 0.5
+        elif roll < 0.6:
+            data['players'].append({'token': f't{next(tokens)}', 'name': 'x', 'is_ready': False, 'in_team': False})
+        elif roll < 0.7 and len(data['players']) > 1:
+            data['players'].pop(rng.randrange(len(data['players'])))
+        elif roll < 0.9:
+            history.append({'quest': len(history)})
+        else:
+            history = data['game_history'] = []
+        patch = diff_state(synced, data)
+        client = apply(client, patch)
+        assert client == data
+        synced = remember_state(data)
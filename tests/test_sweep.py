@@ -0,0 +1,59 @@
+# 閒置房間回收：某個房間回收失敗不能拖累其他房間，也不能讓回收的背景 task 停掉
+import asyncio
+import time
+from collections import OrderedDict
+
+import pytest
+
+import lobby
+import server
+
+
+@pytest.fixture
+def fresh(monkeypatch):
+    monkeypatch.setattr(server, 'journal', None)
+    monkeypatch.setattr(server, 'rooms', {})
+    monkeypatch.setattr(server, 'room_activity', OrderedDict())
+    monkeypatch.setattr(server, 'lobby_index', lobby.Directory(server.lobby_index.max_seats))
+    monkeypatch.setattr(server, 'outbox', {})
+    monkeypatch.setattr(server, 'spectator_outbox', {})
+
+
+def idle_room(room_id):
+    server.commit(room_id, 'join', f'{room_id}-t', 'p', 'a.png')
+    server.rooms[room_id].set_connected(f'{room_id}-t', False)
+    server.room_activity[room_id] = time.monotonic() - server.ROOM_IDLE_TTL - 1
+
+
+def test_failed_eviction_does_not_stop_the_sweep(fresh, monkeypatch):
+    async def close_room(group):
+        if 'a' in group: raise OSError('bus down')
+
+    async def run():
+        for room_id in ('a', 'b', 'c'): idle_room(room_id)
+        monkeypatch.setattr(server, 'close_room', close_room)
+        assert await server.sweep_rooms() == 3
+        await asyncio.gather(*server.flush_tasks)
+        assert server.rooms == {}
+        assert server.lobby_index.entries == {}
+
+    asyncio.run(run())
+
+
+def test_sweeper_survives_errors(fresh, monkeypatch):
+    calls = []
+
+    async def sweep_rooms():
+        calls.append(1)
+        raise OSError('bus down')
+
+    async def run():
+        monkeypatch.setattr(server, 'ROOM_SWEEP_INTERVAL', 0)
+        monkeypatch.setattr(server, 'sweep_rooms', sweep_rooms)
+        task = asyncio.create_task(server.room_sweeper())
+        for _ in range(20): await asyncio.sleep(0)
+        assert not task.done()
+        task.cancel()
+        assert len(calls) > 1
+
+    asyncio.run(run())